@@ -14,3 +14,12 @@ r = conn.get_data(end_time='2021-07-01T21:22:51.984520+00:00',
 elapsed = perf_counter() - start_timer
 print(len(r.json()['data']['getRawHistoryDataWithSampling']))
 print(datetime.now(), f'Got {len(r.content)} bytes in {elapsed} seconds')
+
+print(datetime.now(), 'Starting sharded download request')
+start_timer = perf_counter()
+data = conn.get_data_sharded(end_time='2021-07-01T21:22:51.984520+00:00',
+                             start_time='2021-07-01T21:21:51.984520+00:00',
+                             ids=[5356], shards=12)
+elapsed = perf_counter() - start_timer
+print(datetime.now(), f'Got {len(data[5356][0])} samples in {elapsed} seconds')
+print(conn.metrics.snapshot()['get_data'])
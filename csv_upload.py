@@ -1,35 +1,77 @@
-import csv
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from typing import Iterator, Tuple
+
+import numpy as np
 
 from smip_io2 import SMIP
+from smip_payload import iter_values, load_values, timestamps_from_rate
+from smip_resume import UploadJournal
+
+
+def upload_chunks(conn: SMIP, id: int, chunks: Iterator[Tuple[np.ndarray, np.ndarray]], workers: int = 4,
+                  n: int = 8000) -> int:
+    """Uploads (timestamps, values) chunks as they are produced, with up to workers chunks uploading
+    while the next one is parsed. At most workers + 1 chunks are in memory. Returns the number of samples."""
+    count = 0
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for timestamps, values in chunks:
+            if len(pending) >= workers:
+                pending.popleft().result()
+            pending.append(executor.submit(conn.add_data_stream, id, values, timestamps=timestamps, n=n))
+            count += len(values)
+        for future in pending:
+            future.result()
+    return count
+
+
+def rate_chunks(file, start_time, rate: float, chunk_bytes: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Yields chunks of values from a file, timestamped at rate Hz from start_time."""
+    offset = 0
+    for values in iter_values(file, chunk_bytes):
+        yield timestamps_from_rate(start_time, rate, len(values), offset), values
+        offset += len(values)
+
+
+def ts_chunks(file, chunk_bytes: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Yields chunks of values from a file of value, epoch seconds rows, with timestamps in UTC."""
+    for rows in iter_values(file, chunk_bytes, columns=2):
+        seconds = np.floor(rows[:, 1])
+        ns = seconds.astype(np.int64) * 10 ** 9 + np.round((rows[:, 1] - seconds) * 1e9).astype(np.int64)
+        yield ns.astype('datetime64[ns]'), rows[:, 0]
 
 
-def csv_upload(file, rate: int, id: int) -> None:
-    """Reads values from a csv file, adds timestamps at the rate specified, and uploads to SMIP."""
+def csv_upload(file, rate: int, id: int, journal: str = None, chunk_bytes: int = 2 ** 22) -> None:
+    """Reads values from a csv file, adds timestamps at the rate specified, and uploads to SMIP.
+    The file is read and uploaded in chunks of about chunk_bytes, so memory does not grow with file size.
+    With a journal file, an interrupted upload resumes where it left off, keeping its original start time."""
     conn = SMIP("https://smtamu.cesmii.net/graphql", "test",
                 "smtamu_group", "parthdave", "parth1234")
-    with open(file, 'r') as f:
-        conn.add_data_from_ts(id=id,
-                              entries=f.readlines(),
-                              startTime=datetime.now(timezone.utc),
-                              freq=rate,
-                              async_mode=True)
+    if journal is None:
+        upload_chunks(conn, id, rate_chunks(file, datetime.now(timezone.utc), rate, chunk_bytes))
+        conn.close()
+        return
+    header = UploadJournal.read_header(journal)
+    startTime = header['first'] if header and header.get(
+        'id') == id and 'first' in header else datetime.now(timezone.utc)
+    conn.add_data_resumable(id=id,
+                            values=load_values(file),
+                            journal=journal,
+                            startTime=startTime,
+                            freq=rate)
 
 
-def csv_upload_ts(file, id: int) -> None:
-    """Reads values and timestamps from a csv file and uploads to SMIP."""
+def csv_upload_ts(file, id: int, chunk_bytes: int = 2 ** 22) -> None:
+    """Reads values and UNIX timestamps from a csv file and uploads to SMIP in chunks of about chunk_bytes."""
     conn = SMIP("https://smtamu.cesmii.net/graphql", "test",
                 "smtamu_group", "parthdave", "parth1234")
-    with open(file, 'r', newline='') as f:
-        reader = csv.reader(f)
-        data = [{
-            'timestamp': datetime.fromtimestamp(float(row[1])).isoformat(),
-            'value': row[0],
-            'status': 0
-        } for row in reader]
-        conn.add_data_async(id, data)
+    upload_chunks(conn, id, ts_chunks(file, chunk_bytes))
+    conn.close()
 
 
 if __name__ == "__main__":
-    csv_upload(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
+    csv_upload(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]),
+               sys.argv[4] if len(sys.argv) > 4 else None)
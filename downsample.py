@@ -0,0 +1,32 @@
+"""Visual-fidelity downsampling for time series graphs"""
+
+import numpy as np
+
+
+def minmax_indices(y: np.ndarray, n: int) -> np.ndarray:
+    """Returns sorted indices of the min and max of y in n // 2 equal buckets, so peaks are kept.
+    The first and last samples are always included. Returns all indices if y has n or fewer samples."""
+    y = np.asarray(y, dtype=np.float64)
+    if len(y) <= n or n < 4:
+        return np.arange(len(y))
+    buckets = (n - 2) // 2
+    # Bucket edges over the interior samples
+    edges = np.linspace(1, len(y) - 1, buckets + 1).astype(np.int64)
+    starts, ends = edges[:-1], edges[1:]
+    width = int((ends - starts).max())
+    # Pad buckets to equal width so argmin/argmax run over a 2D view
+    cols = starts[:, None] + np.arange(width)
+    valid = cols < ends[:, None]
+    cols = np.where(valid, cols, starts[:, None])
+    block = y[cols]
+    lo = cols[np.arange(buckets), np.argmin(np.where(valid, block, np.inf), axis=1)]
+    hi = cols[np.arange(buckets), np.argmax(np.where(valid, block, -np.inf), axis=1)]
+    return np.unique(np.concatenate(([0, len(y) - 1], lo, hi)))
+
+
+
+def window_budget(n: int, keep_last: int, points: int) -> int:
+    """Returns how many of the n samples of an update to send to a graph keeping the last keep_last samples,
+    so it holds at most points points whatever the sample rate and however long the update."""
+    shown = min(points, keep_last)
+    return min(shown, max(4, round(shown * n / keep_last)))
@@ -10,6 +10,9 @@ from smip_io2 import SMIP
 conn = SMIP("https://smtamu.cesmii.net/graphql", "test",
             "smtamu_group", "parthdave", "parth1234")
 print(conn.token[-6:])
+# Phase timings of the last request
+last_sample = dict()
+conn.metrics.hooks.append(lambda op, sample: last_sample.update(sample))
 elapsed_times = list()
 start_times = list()
 try:
@@ -32,6 +35,8 @@ try:
         print(len(r.json()['data']['getRawHistoryDataWithSampling']))
         print(datetime.now(),
               f'Got {len(r.content)} bytes in {elapsed} seconds')
+        print(' '.join(f'{phase} {last_sample.get(phase, 0):.4f}'
+                       for phase in ('connect', 'wait', 'download')))
         sleep(1)
 except KeyboardInterrupt:
     plt.plot(start_times, elapsed_times, 'o-')
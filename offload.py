@@ -0,0 +1,170 @@
+"""Process pool for CPU-heavy callback work, with a bounded queue, timeouts and per-callback timing"""
+
+import logging
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from time import monotonic
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+
+
+def _call(fn: Callable, args: tuple, submitted: float, timeout: Optional[float]) -> tuple:
+    """Runs in a worker process. Returns (result, started, finished, skipped); a task that waited in the
+    queue past its timeout is skipped, since nobody is waiting for it anymore.
+    time.monotonic() is system-wide, so times from the submitting process compare with the worker's."""
+    started = monotonic()
+    if timeout is not None and started - submitted > timeout:
+        return None, started, started, True
+    result = fn(*args)
+    return result, started, monotonic(), False
+
+
+def _ready() -> None:
+    pass
+
+
+class OffloadStats:
+    """Counts for one callback since start, plus the queue wait and compute seconds of the last window tasks."""
+
+    def __init__(self, window: int) -> None:
+        self.count = 0
+        # Rejected because the queue was full, skipped after waiting too long, finished after the timeout
+        self.dropped = 0
+        self.skipped = 0
+        self.late = 0
+        self.failed = 0
+        self.wait = 0.0
+        self.compute = 0.0
+        self.recent: deque = deque(maxlen=window)
+
+
+class OffloadPool:
+    """Runs functions of callbacks in worker processes so they don't hold up the callback threads.
+    At most workers + max_queue tasks are pending, more are dropped instead of queued. A task with a
+    timeout is skipped if it is still queued when the timeout passes, and its result is discarded if it
+    arrives after the timeout, so callers never get a stale result. Wait and compute times are kept per
+    callback name, logged every report_interval seconds and returned by snapshot().
+    Workers are spawned rather than forked, so they never inherit locks held by other threads.
+    Functions and their arguments must be picklable, so use module-level functions.
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 2, window: int = 256, report_interval: float = 60,
+                 initializer: Callable = None, initargs: tuple = ()) -> None:
+        self.workers = workers
+        self.max_queue = max_queue
+        self.window = window
+        self.report_interval = report_interval
+        self.__initializer = initializer
+        self.__initargs = initargs
+        self.__context = multiprocessing.get_context('spawn')
+        self.__executor = ProcessPoolExecutor(workers, mp_context=self.__context, initializer=initializer,
+                                              initargs=initargs)
+        self.__lock = threading.Lock()
+        self.__pending = 0
+        self.__stats: Dict[str, OffloadStats] = dict()
+        self.__reported = monotonic()
+
+    def start(self) -> None:
+        """Starts every worker process and waits until they are ready, rather than on the first tasks."""
+        futures = [self.__executor.submit(_ready) for _ in range(self.workers)]
+        for future in futures:
+            future.result()
+
+    def __get(self, name: str) -> OffloadStats:
+        stats = self.__stats.get(name)
+        if stats is None:
+            stats = self.__stats[name] = OffloadStats(self.window)
+        return stats
+
+    def submit(self, name: str, fn: Callable, *args, timeout: float = None) -> Optional[Future]:
+        """Queues fn(*args) for the callback name. Returns a Future of its result, which is None if the
+        task was skipped or finished after timeout seconds, or returns None if the queue is full."""
+        with self.__lock:
+            if self.__pending >= self.workers + self.max_queue:
+                self.__get(name).dropped += 1
+                return None
+            self.__pending += 1
+        submitted = monotonic()
+        try:
+            inner = self.__executor.submit(_call, fn, args, submitted, timeout)
+        except BrokenProcessPool:
+            # A worker died, replace the pool for the next task
+            logging.exception('Offload pool broken, restarting')
+            with self.__lock:
+                self.__pending = 0
+                self.__get(name).failed += 1
+                self.__executor = ProcessPoolExecutor(self.workers, mp_context=self.__context,
+                                                      initializer=self.__initializer, initargs=self.__initargs)
+            return None
+        outer: Future = Future()
+        inner.add_done_callback(lambda f: self.__done(name, submitted, timeout, f, outer))
+        return outer
+
+    def __done(self, name: str, submitted: float, timeout: Optional[float], inner: Future, outer: Future) -> None:
+        arrived = monotonic()
+        error = inner.exception()
+        with self.__lock:
+            self.__pending = max(0, self.__pending - 1)
+            stats = self.__get(name)
+            if error is None:
+                result, started, finished, skipped = inner.result()
+                late = timeout is not None and arrived - submitted > timeout
+                if skipped:
+                    stats.skipped += 1
+                else:
+                    stats.count += 1
+                    stats.late += late
+                    stats.wait += started - submitted
+                    stats.compute += finished - started
+                    stats.recent.append((started - submitted, finished - started))
+            else:
+                stats.failed += 1
+            report = arrived - self.__reported > self.report_interval
+            if report:
+                self.__reported = arrived
+        if error is not None:
+            logging.error('Offloaded %s failed: %r', name, error)
+            outer.set_exception(error)
+        else:
+            outer.set_result(None if skipped or late else result)
+        if report:
+            for op, s in self.snapshot().items():
+                logging.info('%s: %s done, %s dropped, %s skipped, %s late, %s failed, wait p50 %.4f p90 %.4f s, '
+                             'compute p50 %.4f p90 %.4f s', op, s['count'], s['dropped'], s['skipped'], s['late'],
+                             s['failed'], s['wait_p50'], s['wait_p90'], s['compute_p50'], s['compute_p90'])
+
+    def run(self, name: str, fn: Callable, *args, timeout: float = 1.0) -> Any:
+        """Runs fn(*args) in a worker and waits for it. Returns None if it was dropped, skipped, failed
+        or didn't finish within timeout seconds."""
+        future = self.submit(name, fn, *args, timeout=timeout)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout)
+        except Exception:
+            # Timed out, or failed and already logged
+            return None
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Returns the counts of each callback and the p50/p90 queue wait and compute seconds of its recent tasks."""
+        with self.__lock:
+            ops = {name: (stats.count, stats.dropped, stats.skipped, stats.late, stats.failed, stats.wait,
+                          stats.compute, np.array(stats.recent).reshape(-1, 2)) for name, stats in self.__stats.items()}
+        snapshot = dict()
+        for name, (count, dropped, skipped, late, failed, wait, compute, recent) in ops.items():
+            if len(recent):
+                (wait_p50, compute_p50), (wait_p90, compute_p90) = np.percentile(recent, [50, 90], axis=0)
+            else:
+                wait_p50 = compute_p50 = wait_p90 = compute_p90 = 0.0
+            snapshot[name] = {'count': count, 'dropped': dropped, 'skipped': skipped, 'late': late,
+                              'failed': failed, 'wait': wait, 'compute': compute,
+                              'wait_p50': float(wait_p50), 'wait_p90': float(wait_p90),
+                              'compute_p50': float(compute_p50), 'compute_p90': float(compute_p90)}
+        return snapshot
+
+    def close(self) -> None:
+        self.__executor.shutdown(wait=True)
@@ -0,0 +1,48 @@
+"""Compares building upload payloads with add_data_from_ts against the vectorized add_data_array path."""
+
+import json
+import sys
+from datetime import datetime, timezone
+from time import perf_counter
+
+from pandas import date_range
+
+import smip_payload
+from smip_io2 import MUTATION_ADDDATA, SMIP
+
+
+def dict_payload(lines, start_time, freq: float, n: int = 1000) -> int:
+    """Formats payloads the way add_data_from_ts does, including the JSON encoding done by requests."""
+    time_range = date_range(
+        start=start_time, periods=len(lines), freq=f'{1/freq}S')
+    data = [{'timestamp': ts.isoformat(),
+             'value': str(val).strip(),
+             'status': 0} for ts, val in zip(time_range, lines)]
+    return sum(len(json.dumps({"query": MUTATION_ADDDATA, "variables": {"id": 0, "entries": batch}}).encode())
+               for batch in SMIP.batcher(data, n))
+
+
+def array_payload(values, start_time, freq: float, n: int = 1000) -> int:
+    """Formats payloads the way add_data_array does."""
+    timestamps = smip_payload.timestamps_from_rate(
+        start_time, freq, len(values))
+    return sum(len(smip_payload.request_body(MUTATION_ADDDATA, 0, smip_payload.entries_json(
+        timestamps[ndx:ndx + n], values[ndx:ndx + n]))) for ndx in range(0, len(values), n))
+
+
+if __name__ == '__main__':
+    file = sys.argv[1] if len(sys.argv) > 1 else 'Acc.csv'
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    start_time = datetime.now(timezone.utc)
+
+    timer = perf_counter()
+    with open(file, 'r') as f:
+        size = dict_payload(f.readlines(), start_time, rate)
+    dict_t = perf_counter() - timer
+    print(f'add_data_from_ts: {size} bytes in {round(dict_t, 3)} seconds')
+
+    timer = perf_counter()
+    size = array_payload(smip_payload.load_values(file), start_time, rate)
+    array_t = perf_counter() - timer
+    print(f'add_data_array: {size} bytes in {round(array_t, 3)} seconds')
+    print(f'Speedup {round(dict_t / array_t, 2)}x')
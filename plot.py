@@ -1,35 +1,58 @@
 # Standard library imports
 import logging
-from datetime import datetime, timedelta, timezone
-from math import nan
-from time import perf_counter
-from typing import List
+import os
+import tempfile
+import threading
+from datetime import datetime
+from time import monotonic, sleep, time
+from typing import Dict, List, Tuple
 
 # External imports
 import dash
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
 import dash_html_components as html
-import matlab
-import matlab.engine
 import numpy as np
 # import plotly.express as px
 import plotly.graph_objects as go
 from dash.dependencies import MATCH, Input, Output, State
 from dash.exceptions import PreventUpdate
 from pandas import to_datetime
-from scipy import signal
 
 # Local imports
+from downsample import minmax_indices, window_budget
+from offload import OffloadPool
+from poller import SMIPPoller
+from pyramid import AggregatePyramid
+from ringbuffer import SharedRing
+from segmentation import StateTracker
 from smip_io2 import SMIP
-from strptime_fix import strptime_fix
-
-# Establish connection
-conn = SMIP("https://smtamu.cesmii.net/graphql", "test",
-            "smtamu_group", "parthdave", "parth1234")
+from sr_service import PredictorPool
+from stft import RollingSTFT, spectrum
 
 # Define constants
+# Tags that can be shown, all polled in the background
+TAGS = {5366: 'Power', 5356: 'Acceleration', 5348: 'Force'}
 GRAPH_MARGIN = {'l': 40, 'r': 10, 't': 50, 'b': 50}
+# Most points kept on screen by the time portrait, about one per horizontal pixel
+GRAPH_POINTS = 1000
+# Samples kept per tag in shared memory, over a minute at 10 kHz
+RING_CAPACITY = 2 ** 20
+# Most seconds of missed data the poller backfills after falling behind, well within RING_CAPACITY
+MAX_BACKFILL = 60
+# Seconds of history shown by the spectrogram
+SPEC_HISTORY = 60
+# MATLAB engines for surface roughness prediction, from the SR_ENGINES environment variable.
+# Every worker process starts its own, so a host runs this many times the number of workers.
+SR_ENGINES = int(os.environ.get('SR_ENGINES', 1))
+# Processes per worker for FFTs and spectrograms, and seconds a callback waits for them
+NUMERIC_WORKERS = 2
+OFFLOAD_TIMEOUT = 1.0
+# Where the history aggregates are saved, and how often in seconds
+PYRAMID_PATH = 'pyramid.npz'
+PYRAMID_SAVE = 60
+# Time ranges the history graph can show, in seconds
+HISTORY_RANGES = {'Last minute': 60, 'Last hour': 3600, 'Last shift': 8 * 3600, 'Last week': 7 * 86400}
 
 # Set up logging
 fh = logging.FileHandler(filename='plot.log', mode='w')
@@ -39,8 +62,97 @@ logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
                     level=logging.DEBUG if __name__ == '__main__' else logging.WARNING,
                     handlers=[fh, sh])
 
-# Start MATLAB engine
-eng = matlab.engine.start_matlab()
+# Offload workers are spawned, and when this runs as a script each one runs it again as __mp_main__.
+# They only need the task functions, so nothing is connected, loaded or started there.
+_SPAWNED = __name__ == '__mp_main__'
+
+if not _SPAWNED:
+    # Establish connection
+    conn = SMIP("https://smtamu.cesmii.net/graphql", "test",
+                "smtamu_group", "parthdave", "parth1234")
+    # Start MATLAB engines with the surface roughness model loaded, and processes for FFTs
+    predictor = PredictorPool(SR_ENGINES)
+    numeric = OffloadPool(NUMERIC_WORKERS)
+    numeric.start()
+
+# Shared memory ring buffers of samples for each tag, shared by all worker processes.
+# The intermediate-data stores only hold a cursor into these.
+_rings: Dict[int, SharedRing] = dict()
+_rings_lock = threading.Lock()
+
+
+def _ring(id: int) -> SharedRing:
+    """Returns the ring buffer for a tag, creating or attaching to it on first use."""
+    with _rings_lock:
+        if id not in _rings:
+            _rings[id] = SharedRing(f'smip_ring_{id}', RING_CAPACITY)
+        return _rings[id]
+
+
+def _window(cursor: dict) -> Tuple[np.ndarray, np.ndarray]:
+    """Reads the epoch-ns timestamps and values an intermediate-data cursor points to."""
+    return _ring(cursor['id']).read(cursor['start'], cursor['end'])
+
+
+# Min/max/mean aggregates of each tag at several resolutions, for the history graphs
+pyramid = AggregatePyramid()
+if not _SPAWNED and os.path.exists(PYRAMID_PATH):
+    pyramid.load(PYRAMID_PATH)
+_pyramid_saved = monotonic()
+
+
+def _store(id: int, ts: np.ndarray, values: np.ndarray, rate: float) -> None:
+    """Poller sink that appends new samples to the tag's ring buffer."""
+    _ring(id).append(ts, values, rate)
+
+
+def _follow_rings() -> None:
+    """Adds new samples from the ring buffers to this worker's history aggregates once a second, so every
+    worker shows the same history whichever one polls. Only the polling worker saves them."""
+    global _pyramid_saved
+    while True:
+        for id in TAGS:
+            try:
+                pyramid.follow(id, _ring(id))
+            except Exception:
+                logging.exception('Updating history aggregates of %s failed', id)
+        if poller.leader and monotonic() - _pyramid_saved > PYRAMID_SAVE:
+            _pyramid_saved = monotonic()
+            pyramid.save(PYRAMID_PATH)
+        sleep(1)
+
+
+# One poller per host fetches every tag, elected among the worker processes. Callbacks only read the ring buffers.
+if not _SPAWNED:
+    poller = SMIPPoller(conn, list(TAGS), _store, max_backfill=MAX_BACKFILL,
+                        lock_path=os.path.join(tempfile.gettempdir(), 'smip_poller.lock'))
+    poller.start()
+    threading.Thread(target=_follow_rings, daemon=True).start()
+
+
+# Rolling spectrograms, keyed by tag ID, sample rate, segment length and window
+_stfts: Dict[tuple, RollingSTFT] = dict()
+
+
+def _stft(id: int, fs: int, nperseg: int, window: str) -> RollingSTFT:
+    """Returns the rolling spectrogram for a tag and settings, creating it on first use."""
+    key = (id, fs, nperseg, window)
+    if key not in _stfts:
+        _stfts[key] = RollingSTFT(fs, nperseg, window, history=SPEC_HISTORY)
+    return _stfts[key]
+
+
+def _spec_figure(t: np.ndarray, f: np.ndarray, Sxx: np.ndarray) -> go.Figure:
+    """Makes the spectrogram figure. z holds one row per time so new columns can be sent with extendData."""
+    fig = go.Figure(data=go.Heatmap(  # type: ignore
+        z=Sxx, y=f, x=np.datetime_as_string(t.view('datetime64[ns]'), unit='ms'), transpose=True))
+    fig.update_layout(title={
+        'text': f'Spectrogram, last {SPEC_HISTORY} seconds',
+        'x': 0.5,
+        'xanchor': 'center'
+    }, margin=GRAPH_MARGIN)
+    return fig
+
 
 # Page layout stuff
 
@@ -70,7 +182,11 @@ def _graphs(i: int, label: str) -> dbc.Col:
             }
         }, style={'height': '30vh'}, config={'displayModeBar': False}),
         dcc.Graph(id={'type': 'spectrogram', 'index': i}, animate=False, style={'height': '30vh'},
-                  config={'displayModeBar': False})
+                  config={'displayModeBar': False}),
+        dcc.Graph(id={'type': 'history-graph', 'index': i}, animate=False, style={'height': '30vh'},
+                  config={'displayModeBar': False}),
+        # Settings and time of the last spectrogram column sent to this browser
+        dcc.Store(id={'type': 'spec-cursor', 'index': i})
     ], lg=4)
 
 
@@ -80,9 +196,7 @@ def _settings(i: int, id: int, label: str) -> dbc.Col:
             dbc.FormGroup([
                 dbc.Label(f'{label} ID', html_for=f'id{i}'),
                 dbc.Select(id=f'id{i}', options=[
-                    {'label': '5366 (Power)', 'value': 5366},
-                    {'label': '5356 (Acceleration)', 'value': 5356},
-                    {'label': '5348 (Force)', 'value': 5348}
+                    {'label': f'{tag} ({name})', 'value': tag} for tag, name in TAGS.items()
                 ], value=id, persistence=True)
             ]),
             dbc.FormGroup([
@@ -114,6 +228,13 @@ def _settings(i: int, id: int, label: str) -> dbc.Col:
                     {'label': 'Nuttall', 'value': 'nuttall'},
                     {'label': 'Bartlett-Hann', 'value': 'barthann'}
                 ], value='hamming', persistence=True)
+            ]),
+            dbc.FormGroup([
+                dbc.Label('History Range', html_for={
+                          'type': 'history-range', 'index': i}),
+                dbc.Select(id={'type': 'history-range', 'index': i}, options=[
+                    {'label': label, 'value': seconds} for label, seconds in HISTORY_RANGES.items()
+                ], value=3600, persistence=True)
             ])
         ])
     )
@@ -233,9 +354,11 @@ app.layout = dbc.Container([
             interval=1*1000,  # in milliseconds
             n_intervals=0
         ),
-        dcc.Store(id='last_time'),
+        # Ring buffer sequence number of the next sample for each tag
+        dcc.Store(id='last_seq'),
         dcc.Store(id='timer_start'),
-        dcc.Store(id='anomaly_flag', data=False),
+        # Machine state segmentation, carried between batches
+        dcc.Store(id='segmentation'),
         dcc.Store(id='times', data={'run': 0, 'idle': 0, 'down': 0}),
         dcc.Store(id={'type': 'intermediate-data', 'index': 1}),
         dcc.Store(id={'type': 'intermediate-data', 'index': 2})
@@ -280,130 +403,93 @@ def timer(n, power, timer_start):
               Input({'type': 'intermediate-data', 'index': 1}, 'data'),
               Input({'type': 'intermediate-data', 'index': 2}, 'data'))
 def surface_roughness(power, acc):
-    if power is None or acc is None or power['val_list'] is None or acc['val_list'] is None:
+    if power is None or acc is None:
+        raise PreventUpdate
+    _, power_list = _window(power)
+    _, acc_list = _window(acc)
+    if not len(power_list) or not len(acc_list):
         raise PreventUpdate
     feed_rate = 0.4
     wheel_speed = 45.0
     work_speed = 100.0
-    power = matlab.double(power['val_list'])
-    acc_n = matlab.double(acc['val_list'])
-    acc_t = acc_n
-    predict: float = eng.sr_predictor(  # type: ignore
-        feed_rate, wheel_speed, work_speed, power, acc_n, acc_t)
+    # Predict in the background and show the latest finished prediction
+    predictor.submit(feed_rate, wheel_speed, work_speed, power_list, acc_list, acc_list)
+    if predictor.latest is None:
+        raise PreventUpdate
+    predict, latency = predictor.latest
+    logging.debug('Surface roughness latency %s', latency)
     return round(predict, 3)
 
 
 @app.callback(Output({'type': 'intermediate-data', 'index': 1}, 'data'),
               Output({'type': 'intermediate-data', 'index': 2}, 'data'),
-              Output('last_time', 'data'),
+              Output('last_seq', 'data'),
               Output('info', 'children'),
               Input('interval-component', 'n_intervals'),
-              State('last_time', 'data'),
+              State('last_seq', 'data'),
               State('id1', 'value'),
               State('id2', 'value'),
               State('power', 'outline')
               )
-def update_live_data(n, last_time, id1, id2, power):
-    """Callback to get data every second."""
+def update_live_data(n, last_seq, id1, id2, power):
+    """Callback to pass on the samples the poller received since the last update."""
     if power:
         raise PreventUpdate
+    if last_seq is None:
+        last_seq = dict()
+    new_seq = dict()
 
-    timer_start = perf_counter()
-    # 1 sec delay so server has time to add live data
-    end_time = datetime.now(timezone.utc) - timedelta(seconds=1)
-
-    # Initialization and lag prevention
-    if last_time is None or end_time - strptime_fix(last_time) > timedelta(seconds=3):
-        logging.warning('Falling behind! Start %s End %s', last_time, end_time)
-        return dash.no_update, dash.no_update, end_time.isoformat(), dash.no_update
-
-    # Query data from SMIP
-    logging.info(f'start_time {last_time} end_time {end_time}')
-    timer_query_start = perf_counter()
-    r = conn.get_data(last_time, end_time.isoformat(),
-                      [id1, id2], timeout=1)
-    timer_query_end = perf_counter()
-    response_json: dict = r.json()
-    logging.debug(response_json.keys())
-    if 'errors' in response_json:
-        logging.error(response_json)
-        raise Exception()
-    data = response_json['data']['getRawHistoryDataWithSampling']
-    logging.info('Got %s responses in %s seconds', len(
-        data), timer_query_end - timer_query_start)
-
-    # Used for measuring performance
-    start_processing = perf_counter()
-
-    # Unpack data
     def unpack(id: int):
-        """Unpacks return data into time and value lists"""
+        """Returns a cursor to the tag's new samples in its ring buffer"""
         id = int(id)
-        time_list = [i['ts'] for i in data if int(i['id']) == id]
-        val_list = [i['floatvalue'] for i in data if int(i['id']) == id]
-        # SMIP always returns one entry before the start time for each ID, we don't need this
-        if len(time_list) < 2 or len(val_list) < 2:
+        ring = _ring(id)
+        end = ring.count
+        start = last_seq.get(str(id))
+        new_seq[str(id)] = end
+        # Initialization, the first update starts from here
+        if start is None or end <= start:
             return dash.no_update
-        time_list.pop(0)
-        val_list.pop(0)
-        # Measure sampling rate
-        rate = nan
-        if len(time_list) > 1:
-            rate = (strptime_fix(time_list[1])
-                    - strptime_fix(time_list[0])).total_seconds()
-        return {'time_list': time_list, 'val_list': val_list, 'rate': rate}
-
-    # Used for measuring performance
-    data_processed = perf_counter()
-    logging.info('Total %s Query %s Processing %s', data_processed - timer_start, timer_query_end - timer_query_start,
-                 data_processed - start_processing)
-
-    return unpack(id1), unpack(id2), end_time.isoformat(), \
-        [f'Last updated {end_time.astimezone()},',
+        return {'id': id, 'start': start, 'end': end, 'rate': ring.rate}
+
+    data1, data2 = unpack(id1), unpack(id2)
+    last_end = poller.last_end.astimezone() if poller.last_end else None
+    return data1, data2, new_seq, \
+        [f'Last updated {last_end},',
          html.Br(),
-         f'received {len(data)} samples in {round(data_processed - timer_start, 3)} seconds']
+         f'received {poller.received} samples in {round(poller.query_time, 3)} seconds',
+         *([html.Br(), f'caught up {round(poller.backfilled, 3)} seconds'] if poller.backfilled else [])]
 
 
 @app.callback(Output('MachineState', 'value'),
               Output('PartCount', 'value'),
               Output('AnomalousParts', 'value'),
-              Output('anomaly_flag', 'data'),
+              Output('segmentation', 'data'),
+              Output('times', 'data'),
               Input({'type': 'intermediate-data', 'index': 1}, 'data'),
               Input('power', 'outline'),
-              State('MachineState', 'value'),
-              State('PartCount', 'value'),
-              State('AnomalousParts', 'value'),
-              State('anomaly_flag', 'data'),
+              State('segmentation', 'data'),
               State('IdleLevel', 'value'),
               State('AbnormalLevel', 'value'))
-def machine_state(data, power, state, count, anomalous, flag, idle_level, abnormal_level):
+def machine_state(data, power, segmentation, idle_level, abnormal_level):
+    """Classifies every new sample, counting parts, anomalous parts and run/idle/down time in one pass.
+    Multi-second batches after falling behind are segmented the same way as one second ones."""
     if power:
         raise PreventUpdate
     ctx = dash.callback_context
     if ctx.triggered:
         if ctx.triggered[0]['prop_id'] == 'power.outline' and power == False:
-            return None, 0, 0, False
-    if data is None or not data['val_list']:
+            return None, 0, 0, None, {'run': 0, 'idle': 0, 'down': 0}
+    if data is None or not data['rate']:
+        raise PreventUpdate
+    ts, val_list = _window(data)
+    if not len(val_list):
         raise PreventUpdate
-    average = np.mean(data['val_list'])
-    if abs(average) < 1:
-        average = np.mean([v for v in data['val_list'] if v >= 0])
-    if average == 0:
-        new_state = 'MACHINE STOP'
-    elif average < idle_level:
-        new_state = 'MACHINE IDLE'
-    elif average > abnormal_level:
-        new_state = 'ABNORMAL OPERATION'
-    else:
-        new_state = 'NORMAL OPERATION'
-    if state == 'MACHINE STOP' and new_state != 'MACHINE STOP':
-        count += 1
-        flag = False
-    if new_state == 'ABNORMAL OPERATION':
-        if not flag:
-            anomalous += 1
-        flag = True
-    return new_state, count, anomalous, flag
+    tracker = StateTracker() if segmentation is None else StateTracker.from_dict(segmentation)
+    tracker.idle_level = idle_level
+    tracker.abnormal_level = abnormal_level
+    for at, old, new in tracker.update(val_list, data['rate'], ts):
+        logging.debug('State %s -> %s at %s', old, new, to_datetime(at))
+    return tracker.state_name, tracker.parts, tracker.anomalous, tracker.to_dict(), tracker.times
 
 
 @app.callback(Output('GoodParts', 'value'),
@@ -427,48 +513,19 @@ def percent(n):
               Output('IdleTime', 'value'),
               Output('DownTime', 'value'),
               Output('ElapsedTime', 'value'),
-              Output('times', 'data'),
-              Input({'type': 'intermediate-data', 'index': 1}, 'data'),
-              Input('power', 'outline'),
-              Input('percent', 'n_clicks'),
-              State('times', 'data'),
-              State('IdleLevel', 'value'))
-def calculate_times(data, power, percent, times, idle_level):
-    def _percentify(input: List[float]) -> List[str]:
-        return [str(round(x / elapsed * 100, 3)) + '%' for x in input]
-    ctx = dash.callback_context
-    if ctx.triggered:
-        if ctx.triggered[0]['prop_id'] == 'power.outline' and power == False:
-            return 0, 0, 0, 0, {'run': 0, 'idle': 0, 'down': 0}
-        elif ctx.triggered[0]['prop_id'] == 'percent.n_clicks':
-            if percent % 2 == 0:
-                return round(times['run'], 3), round(times['idle'], 3), round(times['down'], 3),\
-                    round(times['run'] + times['idle'] +
-                          times['down'], 3), dash.no_update
-            elapsed = times['run'] + times['idle'] + times['down']
-            if elapsed == 0:
-                raise PreventUpdate
-            return *_percentify([times['run'], times['idle'], times['down']]), round(elapsed, 3), dash.no_update
-    if power:
-        raise PreventUpdate
-    if data is None or not data['val_list'] or not data['rate']:
+              Input('times', 'data'),
+              Input('percent', 'n_clicks'))
+def calculate_times(times, percent):
+    """Shows the run/idle/down times machine_state accumulated, in seconds or as a share of elapsed time."""
+    if times is None:
         raise PreventUpdate
-    arr = np.array(data['val_list'])
-    run_c = len(data['val_list'])
-    idle_c = np.count_nonzero(arr < idle_level)
-    run_c -= idle_c
-    down_c = np.count_nonzero(arr == 0)
-    idle_c -= down_c
-    logging.debug('Run %s Idle %s Down %s Rate %s',
-                  run_c, idle_c, down_c, data['rate'])
-    times['run'] += run_c * data['rate']
-    times['idle'] += idle_c * data['rate']
-    times['down'] += down_c * data['rate']
     elapsed = times['run'] + times['idle'] + times['down']
     if percent % 2 == 0:
-        return round(times['run'], 3), round(times['idle'], 3), round(times['down'], 3),\
-            round(elapsed, 3), times
-    return *_percentify([times['run'], times['idle'], times['down']]), round(elapsed, 3), times
+        return round(times['run'], 3), round(times['idle'], 3), round(times['down'], 3), round(elapsed, 3)
+    if elapsed == 0:
+        raise PreventUpdate
+    return *[str(round(times[key] / elapsed * 100, 3)) + '%' for key in ('run', 'idle', 'down')], \
+        round(elapsed, 3)
 
 
 @app.callback(Output({'type': 'time-graph', 'index': MATCH}, 'extendData'),
@@ -476,11 +533,22 @@ def calculate_times(data, power, percent, times, idle_level):
               State({'type': 'keep_last', 'index': MATCH}, 'value'))
 def update_graph(data, keep_last):
     """Callback that graphs the data."""
-    if data is None or not data['val_list']:
+    if data is None:
+        raise PreventUpdate
+    ts, val_list = _window(data)
+    if not len(val_list):
         raise PreventUpdate
     if keep_last is None:
         keep_last = 1024
-    return {'x': [data['time_list']], 'y': [data['val_list']]}, [0], keep_last
+    # Downsample each update by its share of the window, so the graph holds at most GRAPH_POINTS points
+    # no matter the sample rate or the update length. Min/max buckets keep the peaks.
+    budget = window_budget(len(val_list), keep_last, GRAPH_POINTS)
+    if len(val_list) > budget:
+        index = minmax_indices(val_list, budget)
+        ts, val_list = ts[index], val_list[index]
+    keep_last = min(keep_last, GRAPH_POINTS)
+    time_list = np.datetime_as_string(ts.view('datetime64[ns]'), unit='us')
+    return {'x': [time_list.tolist()], 'y': [val_list.tolist()]}, [0], keep_last
 
 
 @app.callback(Output({'type': 'fft-graph', 'index': MATCH}, 'extendData'),
@@ -489,27 +557,70 @@ def update_fft(data):
     """Callback that calculates and plots FFT."""
     if data is None or data['rate'] is None:
         raise PreventUpdate
-    x = np.fft.rfftfreq(len(data['val_list']), d=data['rate'])[10:]
-    y = np.abs(np.fft.rfft(data['val_list']))[10:]
+    _, val_list = _window(data)
+    result = numeric.run('fft', spectrum, val_list, data['rate'], timeout=OFFLOAD_TIMEOUT)
+    if result is None:
+        raise PreventUpdate
+    x, y = result
     return {'x': [x], 'y': [y]}, [0], len(y)
 
 
 @app.callback(Output({'type': 'spectrogram', 'index': MATCH}, 'figure'),
+              Output({'type': 'spectrogram', 'index': MATCH}, 'extendData'),
+              Output({'type': 'spec-cursor', 'index': MATCH}, 'data'),
               Input({'type': 'intermediate-data', 'index': MATCH}, 'data'),
               State({'type': 'nperseg', 'index': MATCH}, 'value'),
-              State({'type': 'window', 'index': MATCH}, 'value'))
-def update_spec(data, nperseg, window):
-    """Callback that calculates and plots spectrogram."""
-    if data is None or data['val_list'] is None or data['rate'] is None:
+              State({'type': 'window', 'index': MATCH}, 'value'),
+              State({'type': 'spec-cursor', 'index': MATCH}, 'data'))
+def update_spec(data, nperseg, window, spec_cursor):
+    """Callback that calculates and plots spectrogram.
+    Only the columns computed since the last update are sent, unless the settings changed."""
+    if data is None or not data['rate'] > 0 or nperseg is None:
+        raise PreventUpdate
+    stft = _stft(data['id'], round(1/data['rate']), int(nperseg), window)
+    # Updates may have been served by other workers, so read from this STFT's last sample to fill the gap,
+    # but no further back than the spectrogram shows
+    ring = _ring(data['id'])
+    start = data['start'] if stft.last_ts is None else min(data['start'], ring.find(stft.last_ts + 1))
+    start = max(start, data['end'] - int(SPEC_HISTORY / data['rate']))
+    stft.push(*ring.read(start, data['end']),
+              compute=lambda *args: numeric.run('spectrogram', *args, timeout=OFFLOAD_TIMEOUT))
+    t, Sxx = stft.history()
+    if not len(t):
+        raise PreventUpdate
+    key = [data['id'], stft.fs, stft.nperseg, window]
+    cursor = {'key': key, 'last': int(t[-1])}
+    if spec_cursor is None or spec_cursor['key'] != key or not stft.covers(spec_cursor['last']):
+        return _spec_figure(t, stft.freqs, Sxx), dash.no_update, cursor
+    t, Sxx = stft.since(spec_cursor['last'])
+    if not len(t):
         raise PreventUpdate
-    f, t, Sxx = signal.spectrogram(np.asarray(
-        data['val_list']), round(1/data['rate']), nperseg=nperseg, window=window)
-    fig = go.Figure(data=go.Heatmap(z=Sxx, y=f, x=t))  # type: ignore
+    x = np.datetime_as_string(t.view('datetime64[ns]'), unit='ms')
+    return dash.no_update, ({'x': [x.tolist()], 'z': [Sxx.tolist()]}, [0], stft.max_columns), cursor
+
+
+@app.callback(Output({'type': 'history-graph', 'index': MATCH}, 'figure'),
+              Input({'type': 'intermediate-data', 'index': MATCH}, 'data'),
+              State({'type': 'history-range', 'index': MATCH}, 'value'))
+def update_history(data, seconds):
+    """Callback that graphs the min/max band and mean over the history range from the aggregates."""
+    if data is None or seconds is None:
+        raise PreventUpdate
+    end = int(time() * 1e9)
+    buckets = pyramid.query(data['id'], end - int(seconds) * 10 ** 9, end, GRAPH_POINTS)
+    x = np.datetime_as_string(buckets['start'].view('datetime64[ns]'), unit='ms').tolist()
+    fig = go.Figure([
+        go.Scatter(x=x, y=buckets['max'], mode='lines', line={'width': 0}, name='Max'),  # type: ignore
+        go.Scatter(x=x, y=buckets['min'], mode='lines', line={'width': 0}, fill='tonexty',  # type: ignore
+                   name='Min'),
+        go.Scatter(x=x, y=buckets['mean'], mode='lines', name='Mean')  # type: ignore
+    ])
+    label = next((label for label, s in HISTORY_RANGES.items() if s == int(seconds)), '')
     fig.update_layout(title={
-        'text': 'Spectrogram, last second',
+        'text': f'History, {label.lower()}',
         'x': 0.5,
         'xanchor': 'center'
-    }, margin=GRAPH_MARGIN)
+    }, margin=GRAPH_MARGIN, showlegend=False)
     return fig
 
 
@@ -0,0 +1,156 @@
+"""Background thread that polls SMIP for new samples once per interval, independent of how many clients read them"""
+
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from math import ceil
+from time import monotonic, perf_counter
+from typing import Callable, List
+
+import numpy as np
+
+from smip_io2 import SMIP
+
+try:
+    import fcntl
+except ImportError:  # Windows, where waitress serves from a single process
+    fcntl = None
+
+
+class SMIPPoller(threading.Thread):
+    """Queries every tag in ids once per interval and hands new samples to sink(id, ts, values, rate),
+    with epoch-ns timestamps, float64 values and the sampling period in seconds.
+    Queries end delay seconds in the past so SMIP has time to add live data.
+    If the last poll ended more than max_lag seconds ago, the gap is backfilled with concurrent queries
+    of shard_seconds each and passed on as one batch. Gaps longer than max_backfill seconds are only
+    backfilled for their last max_backfill seconds.
+    With a lock_path, only the process holding a lock on it polls, so a host queries SMIP once per interval
+    however many worker processes it runs. The others follow the poller's status, which it writes to
+    lock_path.json, and take over where it left off if it exits.
+    """
+
+    def __init__(self, conn: SMIP, ids: List[int], sink: Callable[[int, np.ndarray, np.ndarray, float], None],
+                 interval: float = 1.0, delay: float = 1.0, timeout: float = 1.0, max_lag: float = 3.0,
+                 max_backfill: float = 60.0, shard_seconds: float = 5.0, fan_out: int = 8,
+                 backfill_timeout: float = 10.0, lock_path: str = None) -> None:
+        super().__init__(daemon=True)
+        self.conn = conn
+        self.ids = ids
+        self.sink = sink
+        self.interval = interval
+        self.delay = delay
+        self.timeout = timeout
+        self.max_lag = max_lag
+        self.max_backfill = max_backfill
+        self.shard_seconds = shard_seconds
+        self.fan_out = fan_out
+        self.backfill_timeout = backfill_timeout
+        self.lock_path = lock_path
+        # Whether this process polls, rather than following another one
+        self.leader = lock_path is None or fcntl is None
+        self.__lock_file = None
+        # End time of the last successful query
+        self.last_end: datetime = None
+        self.received = 0
+        self.query_time = 0.0
+        # Seconds backfilled by the last poll, and seconds given up on since start
+        self.backfilled = 0.0
+        self.dropped = 0.0
+        self.__stop = threading.Event()
+
+    def stop(self) -> None:
+        self.__stop.set()
+
+    def run(self) -> None:
+        next_tick = monotonic()
+        while not self.__stop.is_set():
+            try:
+                if self.__elect():
+                    self.poll()
+                    self.__publish()
+                else:
+                    self.__follow()
+            except Exception:
+                logging.exception('Polling SMIP failed')
+            next_tick = max(next_tick + self.interval, monotonic())
+            self.__stop.wait(next_tick - monotonic())
+
+    def __elect(self) -> bool:
+        """Tries to become the process that polls on this host, returns whether it is."""
+        if self.leader:
+            return True
+        if self.__lock_file is None:
+            self.__lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(self.__lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        # Held until this process exits. Continue from the last poll of the previous poller, if any.
+        self.leader = True
+        self.__follow()
+        logging.info('Polling SMIP for this host from %s', self.last_end)
+        return True
+
+    def __publish(self) -> None:
+        """Writes the status of the last poll for the processes following this one."""
+        if self.lock_path is None:
+            return
+        status = {'last_end': self.last_end.isoformat() if self.last_end else None, 'received': self.received,
+                  'query_time': self.query_time, 'backfilled': self.backfilled, 'dropped': self.dropped}
+        tmp = f'{self.lock_path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(status, f)
+        os.replace(tmp, f'{self.lock_path}.json')
+
+    def __follow(self) -> None:
+        """Reads the status of the last poll by the process polling for this host."""
+        try:
+            with open(f'{self.lock_path}.json') as f:
+                status = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self.last_end = datetime.fromisoformat(status['last_end']) if status['last_end'] else None
+        self.received = status['received']
+        self.query_time = status['query_time']
+        self.backfilled = status['backfilled']
+        self.dropped = status['dropped']
+
+    def poll(self) -> None:
+        """Queries samples since the last poll and passes them on."""
+        end_time = datetime.now(timezone.utc) - timedelta(seconds=self.delay)
+        if self.last_end is None:
+            self.last_end = end_time
+            return
+        lag = (end_time - self.last_end).total_seconds()
+        if lag > self.max_backfill:
+            logging.warning('Falling behind! Dropping %s seconds from %s',
+                            lag - self.max_backfill, self.last_end)
+            self.dropped += lag - self.max_backfill
+            self.last_end = end_time - timedelta(seconds=self.max_backfill)
+            lag = self.max_backfill
+        timer_query_start = perf_counter()
+        if lag > self.max_lag:
+            logging.warning('Backfilling %s seconds from %s', lag, self.last_end)
+            data = self.conn.get_data_sharded(self.last_end.isoformat(), end_time.isoformat(), self.ids,
+                                              shards=ceil(lag / self.shard_seconds), fan_out=self.fan_out,
+                                              timeout=self.backfill_timeout)
+        else:
+            data = self.conn.get_data_arrays(self.last_end.isoformat(), end_time.isoformat(),
+                                             self.ids, timeout=self.timeout)
+        self.query_time = perf_counter() - timer_query_start
+        start_ns = int(self.last_end.timestamp() * 1e6) * 1000
+        self.received = 0
+        for id, (ts, values) in data.items():
+            # SMIP always returns one entry before the start time for each ID, we don't need this
+            keep = ts >= start_ns
+            ts, values = ts[keep], values[keep]
+            if not len(ts):
+                continue
+            rate = float(ts[1] - ts[0]) / 1e9 if len(ts) > 1 else None
+            self.sink(id, ts, values, rate)
+            self.received += len(ts)
+        self.backfilled = lag if lag > self.max_lag else 0.0
+        logging.info('Got %s samples in %s seconds', self.received, self.query_time)
+        self.last_end = end_time
@@ -0,0 +1,180 @@
+"""Multi-resolution min/max/mean/count aggregates of each tag, for long-range history views"""
+
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# One aggregate bucket
+ROW = np.dtype([('start', np.int64), ('min', np.float64), ('max', np.float64),
+                ('sum', np.float64), ('count', np.int64)])
+# (bucket width in seconds, buckets kept) of each level, finest first
+LEVELS = ((0.01, 360000), (1, 86400), (60, 43200), (3600, 17520))
+
+
+def aggregate(ts: np.ndarray, values: np.ndarray, width: int) -> np.ndarray:
+    """Aggregates sorted samples with epoch-ns timestamps into buckets of width ns."""
+    bucket = ts // width
+    first = np.concatenate(([0], np.flatnonzero(np.diff(bucket)) + 1))
+    rows = np.empty(len(first), dtype=ROW)
+    rows['start'] = bucket[first] * width
+    rows['min'] = np.minimum.reduceat(values, first)
+    rows['max'] = np.maximum.reduceat(values, first)
+    rows['sum'] = np.add.reduceat(values, first)
+    rows['count'] = np.diff(np.append(first, len(ts)))
+    return rows
+
+
+def merge(rows: np.ndarray, width: int) -> np.ndarray:
+    """Combines buckets into coarser buckets of width ns."""
+    bucket = rows['start'] // width
+    first = np.concatenate(([0], np.flatnonzero(np.diff(bucket)) + 1))
+    merged = np.empty(len(first), dtype=ROW)
+    merged['start'] = bucket[first] * width
+    merged['min'] = np.minimum.reduceat(rows['min'], first)
+    merged['max'] = np.maximum.reduceat(rows['max'], first)
+    merged['sum'] = np.add.reduceat(rows['sum'], first)
+    merged['count'] = np.add.reduceat(rows['count'], first)
+    return merged
+
+
+class Level:
+    """Buckets of one width, the last of which may still be filling. Only the newest retention are kept."""
+
+    def __init__(self, width: int, retention: int, rows: np.ndarray = None) -> None:
+        self.width = width
+        self.retention = retention
+        self.__rows = np.empty(1024, dtype=ROW) if rows is None else rows.copy()
+        self.__n = 0 if rows is None else len(rows)
+
+    @property
+    def rows(self) -> np.ndarray:
+        return self.__rows[:self.__n]
+
+    def add(self, rows: np.ndarray) -> None:
+        """Appends buckets newer than the open one, merging into it the bucket it shares a start with."""
+        if self.__n and len(rows) and rows['start'][0] == self.__rows['start'][self.__n - 1]:
+            last = self.__rows[self.__n - 1]
+            last['min'] = min(last['min'], rows['min'][0])
+            last['max'] = max(last['max'], rows['max'][0])
+            last['sum'] += rows['sum'][0]
+            last['count'] += rows['count'][0]
+            rows = rows[1:]
+        if not len(rows):
+            return
+        if self.__n + len(rows) > len(self.__rows):
+            # Drop what is past retention, then grow
+            keep = self.__rows[max(0, self.__n + len(rows) - self.retention):self.__n]
+            self.__rows = np.empty(max(2 * len(keep), len(keep) + len(rows), 1024), dtype=ROW)
+            self.__rows[:len(keep)] = keep
+            self.__n = len(keep)
+        self.__rows[self.__n:self.__n + len(rows)] = rows
+        self.__n += len(rows)
+
+    def oldest(self) -> int:
+        """Start of the oldest bucket still kept, past retention or not."""
+        n = min(self.__n, self.retention)
+        return int(self.__rows['start'][self.__n - n]) if n else None
+
+    def range(self, start: int, end: int) -> np.ndarray:
+        """Returns the kept buckets overlapping [start, end]."""
+        rows = self.rows[-self.retention:]
+        lo = int(np.searchsorted(rows['start'], start - self.width, 'right'))
+        hi = int(np.searchsorted(rows['start'], end, 'right'))
+        return rows[lo:hi]
+
+
+class AggregatePyramid:
+    """Keeps min, max, sum and count per bucket of each tag at several resolutions (10 ms, 1 s, 1 min, 1 h
+    by default), updated incrementally as samples arrive. A query for any time range is answered from the
+    finest level that still covers it, merged down to at most max_points buckets.
+    """
+
+    def __init__(self, levels: Tuple[Tuple[float, int], ...] = LEVELS) -> None:
+        self.levels = levels
+        self.__lock = threading.Lock()
+        self.__tags: Dict[int, list] = dict()
+        # Epoch-ns timestamps of the first and last sample added per tag
+        self.__first: Dict[int, int] = dict()
+        self.__last: Dict[int, int] = dict()
+
+    def __tag(self, id: int) -> list:
+        if id not in self.__tags:
+            self.__tags[id] = [Level(int(round(width * 1e9)), retention) for width, retention in self.levels]
+        return self.__tags[id]
+
+    def add(self, id: int, ts: np.ndarray, values: np.ndarray) -> None:
+        """Adds samples with sorted epoch-ns timestamps. Samples not newer than the last one and NaNs are ignored."""
+        with self.__lock:
+            keep = ~np.isnan(values)
+            if id in self.__last:
+                keep &= ts > self.__last[id]
+            ts, values = ts[keep], values[keep]
+            if not len(ts):
+                return
+            self.__first.setdefault(id, int(ts[0]))
+            self.__last[id] = int(ts[-1])
+            for level in self.__tag(id):
+                level.add(aggregate(ts, values, level.width))
+
+    def last(self, id: int) -> Optional[int]:
+        """Returns the epoch-ns timestamp of the last sample added for a tag, or None if there is none."""
+        with self.__lock:
+            return self.__last.get(id)
+
+    def follow(self, id: int, ring) -> int:
+        """Adds the samples of a tag's SharedRing newer than the last one added, so every process reading
+        the ring keeps the same aggregates. Returns how many samples were read."""
+        last = self.last(id)
+        count = ring.count
+        start = max(count - ring.capacity, 0) if last is None else ring.find(last + 1)
+        ts, values = ring.read(start, count)
+        self.add(id, ts, values)
+        return len(ts)
+
+    def query(self, id: int, start: int, end: int, max_points: int = 2000) -> Dict[str, np.ndarray]:
+        """Returns the buckets of a tag between epoch-ns times start and end as arrays of start time
+        (epoch ns), min, max, mean and count, with at most max_points buckets."""
+        with self.__lock:
+            levels = self.__tags.get(id)
+            rows = np.empty(0, dtype=ROW)
+            width = None
+            if levels is not None:
+                # Anything before the first sample is covered by every level
+                covered_from = max(start, self.__first[id])
+                candidates = [level for level in levels
+                              if level.oldest() is not None and level.oldest() <= covered_from]
+                for level in candidates or levels[-1:]:
+                    width = level.width
+                    if (end - start) / level.width <= 4 * max_points:
+                        break
+                rows = level.range(start, end)
+        if len(rows) > max_points and width is not None:
+            factor = -(-len(rows) // max_points)
+            rows = merge(rows, width * factor)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = rows['sum'] / rows['count']
+        return {'start': rows['start'], 'min': rows['min'], 'max': rows['max'],
+                'mean': mean, 'count': rows['count']}
+
+    def save(self, path: str) -> None:
+        """Writes every level of every tag to an .npz file, replacing it atomically."""
+        with self.__lock:
+            arrays = {f'{id}_{i}': level.rows[-level.retention:]
+                      for id, levels in self.__tags.items() for i, level in enumerate(levels)}
+            arrays.update({f'{id}_span': np.array([self.__first[id], self.__last[id]])
+                           for id in self.__tags})
+        tmp = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+
+    def load(self, path: str) -> None:
+        """Replaces the aggregates with those saved in an .npz file."""
+        with np.load(path) as saved:
+            ids = {int(key.split('_')[0]) for key in saved.files}
+            with self.__lock:
+                for id in ids:
+                    self.__first[id], self.__last[id] = (int(x) for x in saved[f'{id}_span'])
+                    self.__tags[id] = [Level(int(round(width * 1e9)), retention, saved[f'{id}_{i}'])
+                                       for i, (width, retention) in enumerate(self.levels)]
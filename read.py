@@ -1,18 +1,129 @@
 import sys
-from datetime import datetime, timedelta, timezone
-from typing import List
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import time
+from typing import List, Tuple
 
 import nidaqmx
-import requests
+import numpy as np
 from nidaqmx.constants import AcquisitionType, LoggingMode, LoggingOperation
+from nidaqmx.stream_readers import AnalogMultiChannelReader
 
-from smip_io import add_data, update_token
+from smip_io2 import SMIP
+from spool import Spool
 
 
-def read_data(sample_rate: int, channels: List[str], ids: List[int]):
-    token = ''
-    time_step = timedelta(seconds=1/sample_rate)
-    with requests.Session() as s:
+class PipelineStats:
+    """Thread-safe counters for the acquisition pipeline."""
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.read = 0
+        self.uploaded = 0
+        self.late = 0
+        self.failed = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        # Spool segments and bytes dropped unread, and bytes waiting to be uploaded
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.depth = 0
+
+    def add(self, **counts) -> None:
+        with self.__lock:
+            for name, n in counts.items():
+                setattr(self, name, getattr(self, name) + n)
+
+    def done(self, latency: float, late: bool) -> None:
+        """Records an uploaded block and its latency from being taken to being uploaded."""
+        with self.__lock:
+            self.uploaded += 1
+            self.late += late
+            # Exponentially weighted average
+            self.latency += 0.1 * (latency - self.latency) if self.uploaded > 1 else latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def spooled(self, spool: Spool) -> None:
+        """Records the drop counts and backlog of the spool."""
+        depth = spool.backlog
+        with self.__lock:
+            self.dropped, self.dropped_bytes, self.depth = spool.dropped, spool.dropped_bytes, depth
+
+
+def entry_arrays(records: list) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the datetime64[ns] timestamps and values of spool records in one vectorized step.
+    Timestamps are computed from each sample's index in its block, so no rounding error accumulates."""
+    lengths = np.array([len(values) for (_, _, _, values) in records])
+    t0 = np.repeat([t0 for (_, t0, _, _) in records], lengths)
+    step = np.repeat([step * 1e9 for (_, _, step, _) in records], lengths)
+    index = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    timestamps = (t0 + np.round(index * step).astype(np.int64)).view('datetime64[ns]')
+    return timestamps, np.concatenate([values for (_, _, _, values) in records])
+
+
+def upload_tag(conn: SMIP, id: int, records: list) -> None:
+    """Uploads the records of one tag."""
+    timestamps, values = entry_arrays(records)
+    conn.add_data_array(id, values, timestamps=timestamps, async_mode=False)
+
+
+def drain(conn: SMIP, spool: Spool, stats: PipelineStats, stop: threading.Event, workers: int,
+          deadline: float, batch: int, backoff: float = 1.0, max_backoff: float = 30.0) -> None:
+    """Uploads the spool in batches of up to batch samples, one tag per worker, until stop is set.
+    A batch is only committed once every tag in it was uploaded, otherwise it is retried with backoff.
+    Whatever is left when stopping stays in the spool for the next run."""
+    delay = backoff
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while not stop.is_set():
+            records, position = spool.read(batch)
+            if not records:
+                stop.wait(0.1)
+                continue
+            by_tag = defaultdict(list)
+            for record in records:
+                by_tag[record[0]].append(record)
+            try:
+                for future in [executor.submit(upload_tag, conn, id, tag_records)
+                               for (id, tag_records) in by_tag.items()]:
+                    future.result()
+            except Exception as e:
+                stats.add(failed=1)
+                print(datetime.now(), 'Upload failed, retrying in', delay, 'seconds', e)
+                stop.wait(delay)
+                delay = min(delay * 2, max_backoff)
+                continue
+            delay = backoff
+            spool.commit(position)
+            now = time()
+            for (_, t0, step, values) in records:
+                # From the last sample being taken to it being uploaded
+                latency = now - t0 / 1e9 - step * len(values)
+                stats.done(latency, latency > deadline)
+
+
+def read_data(sample_rate: int, channels: List[str], ids: List[int], workers: int = None,
+              spool_dir: str = 'spool', max_spool: int = 2 ** 30, deadline: float = 3.0, batch: int = 2 ** 16,
+              metrics_port: int = 9108):
+    """Reads 1 second blocks from the DAQ into a spool on disk, which a background thread uploads.
+    If SMIP is slow or unreachable the backlog builds up in the spool, up to max_spool bytes, and is
+    uploaded in batches of up to batch samples once it recovers. Blocks left over from an earlier run are
+    uploaded first. Blocks that take longer than deadline seconds from being taken to being uploaded are late.
+    Tags are uploaded concurrently, on one worker each unless workers is given.
+    SMIP request metrics are served for Prometheus on metrics_port, unless it is None.
+    """
+    conn = SMIP("https://smtamu.cesmii.net/graphql", "test",
+                "smtamu_group", "parthdave", "parth1234")
+    if metrics_port is not None:
+        conn.metrics.serve(metrics_port)
+    spool = Spool(spool_dir, max_bytes=max_spool)
+    stats = PipelineStats()
+    workers = workers or len(ids)
+    stop = threading.Event()
+    drainer = threading.Thread(target=drain, args=(conn, spool, stats, stop, workers, deadline, batch))
+    drainer.start()
+    try:
         with nidaqmx.Task() as task:
             task.in_stream.configure_logging(
                 'log.tdms', logging_mode=LoggingMode.LOG_AND_READ, operation=LoggingOperation.CREATE_OR_REPLACE)
@@ -22,30 +133,30 @@ def read_data(sample_rate: int, channels: List[str], ids: List[int]):
                 sample_rate, sample_mode=AcquisitionType.CONTINUOUS)
             # Supposed to set the buffer, not sure if actually takes effect
             task.timing.samp_quant_samp_per_chan = 200000
+            # Reads straight into a (channel, sample) array, without going through lists
+            reader = AnalogMultiChannelReader(task.in_stream)
+            buf = np.empty((len(channels), sample_rate))
             task.start()
-            ts = datetime.now(timezone.utc)
+            start = int(time() * 1e6) * 1000
+            block = 0
             while True:
                 # Take 1 second of samples
-                buf = task.read(sample_rate)
-                # Format each sample into a GraphQL TimeSeriesEntryInput object
-                points = [[] for _ in range(len(ids))]
-                for samples in zip(*buf):
-                    for i in range(len(ids)):
-                        points[i].append({
-                            "timestamp": ts.isoformat(),
-                            "value": str(samples[i]),
-                            "status": 0
-                        })
-                    ts += time_step
-                # Test JWT validity
-                token = update_token(
-                    token, 'test', 'smtamu_group', 'parthdave', 'parth1234')
-                # Batch upload
-                r_list = [add_data(id, entries, token, session=s)
-                          for (entries, id) in zip(points, ids)]
-                # Receive response
-                for r in r_list:
-                    print(datetime.now(), r.json(), 'Elapsed', r.elapsed)
+                reader.read_many_sample(buf, sample_rate)
+                stats.add(read=1)
+                for (values, id) in zip(buf, ids):
+                    spool.append(id, start + block * 10 ** 9, 1 / sample_rate, values)
+                block += 1
+                stats.spooled(spool)
+                print(datetime.now(), 'Backlog', stats.depth, 'bytes', 'Read', stats.read, 'Uploaded', stats.uploaded,
+                      'Dropped', stats.dropped, 'segments', stats.dropped_bytes, 'bytes',
+                      'Late', stats.late, 'Failed', stats.failed,
+                      'Latency', round(stats.latency, 3), 'Max', round(stats.max_latency, 3),
+                      'In', round(spool.write_rate), 'Out', round(spool.drain_rate), 'samples/s')
+    finally:
+        stop.set()
+        drainer.join()
+        spool.close()
+        conn.close()
 
 
 if __name__ == '__main__':
@@ -54,4 +165,5 @@ if __name__ == '__main__':
     else:
         mod_list = sys.argv[2].split(',')
         id_list = [int(id) for id in sys.argv[3].split(',')]
-        read_data(int(sys.argv[1]), mod_list, id_list)
+        workers = int(sys.argv[4]) if len(sys.argv) > 4 else None
+        read_data(int(sys.argv[1]), mod_list, id_list, workers)
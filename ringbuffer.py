@@ -0,0 +1,167 @@
+"""Per-tag ring buffer of samples in shared memory, readable by every worker process"""
+
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, Iterator, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows, where waitress serves from a single process
+    fcntl = None
+
+# Header slots, int64 each
+_SEQ, _COUNT, _CAPACITY, _RATE = range(4)
+_HEADER = 4
+# Times a reader retries while writes overlap before it takes the writers' lock
+_SPINS = 1000
+
+
+class SharedRing:
+    """Fixed-capacity ring of (epoch-ns timestamp, value) samples in a named shared memory segment.
+    Samples are addressed by their sequence number, the count of samples written before them,
+    so readers can pass around small (start, end) cursors instead of the samples themselves.
+    Writers are serialized with a file lock and only append samples newer than the last one,
+    so several processes can write the same data. Readers don't lock, they retry if a write overlapped,
+    and only take the writers' lock if writes keep overlapping or a writer died in the middle of one.
+    """
+
+    def __init__(self, name: str, capacity: int = 2 ** 20) -> None:
+        self.name = name
+        size = 8 * (_HEADER + 2 * capacity)
+        try:
+            self.__shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            created = True
+        except FileExistsError:
+            self.__shm = shared_memory.SharedMemory(name=name)
+            created = False
+        # The segment outlives any one worker, so don't let the resource tracker unlink it at exit
+        if os.name == 'posix':
+            resource_tracker.unregister(self.__shm._name, 'shared_memory')
+        self.__header = np.ndarray((_HEADER,), dtype=np.int64, buffer=self.__shm.buf)
+        if created:
+            self.__header[:] = 0
+            self.__header[_CAPACITY] = capacity
+        self.capacity = int(self.__header[_CAPACITY])
+        offset = 8 * _HEADER
+        self.__ts = np.ndarray((self.capacity,), dtype=np.int64,
+                               buffer=self.__shm.buf, offset=offset)
+        self.__values = np.ndarray((self.capacity,), dtype=np.float64,
+                                   buffer=self.__shm.buf, offset=offset + 8 * self.capacity)
+        self.__rate = self.__header[_RATE:_RATE + 1].view(np.float64)
+        self.__thread_lock = threading.Lock()
+        self.__lock_file = open(os.path.join(tempfile.gettempdir(), name + '.lock'), 'a') if fcntl else None
+        if not created:
+            with self.__locked():
+                self.__repair()
+
+    @contextmanager
+    def __locked(self) -> Iterator[None]:
+        """Holds the writers' lock, across threads and processes."""
+        with self.__thread_lock:
+            if self.__lock_file is not None:
+                fcntl.flock(self.__lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if self.__lock_file is not None:
+                    fcntl.flock(self.__lock_file, fcntl.LOCK_UN)
+
+    def __repair(self) -> None:
+        """Ends a write left unfinished by a writer that died, while holding the writers' lock.
+        The count only moves once the samples are written, so the ring is consistent either way."""
+        if self.__header[_SEQ] % 2:
+            self.__header[_SEQ] += 1
+
+    def __consistent(self, read: Callable):
+        """Returns read() from a moment no write was in progress."""
+        for _ in range(_SPINS):
+            seq = int(self.__header[_SEQ])
+            if seq % 2:
+                continue
+            result = read()
+            if int(self.__header[_SEQ]) == seq:
+                return result
+        with self.__locked():
+            self.__repair()
+            return read()
+
+    @property
+    def count(self) -> int:
+        """Sequence number of the next sample to be written."""
+        return int(self.__header[_COUNT])
+
+    @property
+    def rate(self) -> float:
+        """Sampling period in seconds, as given to the last append."""
+        return float(self.__rate[0])
+
+    def __physical(self, start: int, end: int) -> Tuple[slice, slice]:
+        """Splits the sequence range [start, end) into at most two slices of the arrays."""
+        lo, hi = start % self.capacity, end % self.capacity
+        if end - start == 0:
+            return slice(0, 0), slice(0, 0)
+        if lo < hi:
+            return slice(lo, hi), slice(0, 0)
+        return slice(lo, self.capacity), slice(0, hi)
+
+    def append(self, ts: np.ndarray, values: np.ndarray, rate: float = None) -> int:
+        """Appends the samples newer than the last one written, returns the new count."""
+        with self.__locked():
+            count = self.count
+            if count:
+                newer = ts > self.__ts[(count - 1) % self.capacity]
+                ts, values = ts[newer], values[newer]
+            ts, values = ts[-self.capacity:], values[-self.capacity:]
+            if not len(ts):
+                return count
+            first, second = self.__physical(count, count + len(ts))
+            split = first.stop - first.start
+            # Odd sequence while writing
+            self.__header[_SEQ] += 1
+            self.__ts[first], self.__values[first] = ts[:split], values[:split]
+            self.__ts[second], self.__values[second] = ts[split:], values[split:]
+            if rate is not None:
+                self.__rate[0] = rate
+            self.__header[_COUNT] = count + len(ts)
+            self.__header[_SEQ] += 1
+            return count + len(ts)
+
+    def read(self, start: int, end: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns copies of the timestamps and values of samples [start, end) still in the ring."""
+        def read() -> Tuple[np.ndarray, np.ndarray]:
+            count = self.count
+            lo, hi = max(start, count - self.capacity, 0), min(end, count)
+            first, second = self.__physical(lo, max(lo, hi))
+            return (np.concatenate((self.__ts[first], self.__ts[second])),
+                    np.concatenate((self.__values[first], self.__values[second])))
+        return self.__consistent(read)
+
+    def find(self, ts: int) -> int:
+        """Returns the sequence number of the first sample at or after the epoch-ns timestamp ts."""
+        def find() -> int:
+            count = self.count
+            oldest = max(count - self.capacity, 0)
+            first, second = self.__physical(oldest, count)
+            pos = int(np.searchsorted(self.__ts[first], ts))
+            if pos == first.stop - first.start:
+                pos += int(np.searchsorted(self.__ts[second], ts))
+            return oldest + pos
+        return self.__consistent(find)
+
+    def close(self) -> None:
+        # Views into the segment must be released before it can be closed
+        self.__header = self.__ts = self.__values = self.__rate = None
+        self.__shm.close()
+        if self.__lock_file is not None:
+            self.__lock_file.close()
+
+    def unlink(self) -> None:
+        """Removes the shared memory segment once no process needs it."""
+        if os.name == 'posix':
+            resource_tracker.register(self.__shm._name, 'shared_memory')
+        self.__shm.unlink()
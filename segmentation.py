@@ -0,0 +1,148 @@
+"""Sample-resolution machine state segmentation of power data"""
+
+from typing import List, Tuple
+
+import numpy as np
+
+# Machine states, in order of power
+STOP, IDLE, NORMAL, ABNORMAL = range(4)
+STATE_NAMES = ('MACHINE STOP', 'MACHINE IDLE', 'NORMAL OPERATION', 'ABNORMAL OPERATION')
+
+
+def classify(values: np.ndarray, tail: np.ndarray, window: int, idle_level: float,
+             abnormal_level: float) -> np.ndarray:
+    """Classifies every sample by the mean of the window samples ending at it, continuing from the samples
+    in tail. Like the per-second classification, the machine is stopped if no sample in the window is
+    positive, and negative samples are ignored when the mean is under 1."""
+    buf = np.concatenate((tail, values))
+    skip = len(tail)
+
+    def window_sums(x: np.ndarray) -> np.ndarray:
+        # Zeros before the start make the first windows partial
+        csum = np.concatenate((np.zeros(window + 1), np.cumsum(x)))
+        return csum[window + skip + 1:] - csum[skip + 1:len(csum) - window]
+
+    size = np.minimum(np.arange(skip + 1, len(buf) + 1), window)
+    mean = window_sums(buf) / size
+    low = np.flatnonzero(np.abs(mean) < 1)
+    if len(low):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean[low] = window_sums(np.maximum(buf, 0))[low] / window_sums(buf >= 0)[low]
+    stopped = window_sums(buf > 0) == 0
+    states = np.full(len(values), NORMAL, dtype=np.int8)
+    states[mean < idle_level] = IDLE
+    states[mean > abnormal_level] = ABNORMAL
+    states[stopped] = STOP
+    return states
+
+
+def runs(states: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Run-length encodes states, returns the state and length of each run."""
+    if not len(states):
+        return np.empty(0, dtype=np.int8), np.empty(0, dtype=np.int64)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(states)) + 1))
+    return states[starts], np.diff(np.append(starts, len(states)))
+
+
+class StateTracker:
+    """Segments power data into machine states at sample resolution, counting parts, anomalous parts
+    and the seconds spent running, idle and down in one pass over each batch.
+    Each sample is classified by the mean of the last smooth seconds, and runs shorter than min_duration
+    seconds are absorbed into the state before them. A run at the end of a batch that is still too short
+    is held until the next batch decides it. The whole state round-trips through to_dict()/from_dict().
+    """
+
+    def __init__(self, idle_level: float = 100, abnormal_level: float = 5800, smooth: float = 0.05,
+                 min_duration: float = 0.25) -> None:
+        self.idle_level = idle_level
+        self.abnormal_level = abnormal_level
+        self.smooth = smooth
+        self.min_duration = min_duration
+        self.state: int = None
+        self.parts = 0
+        self.anomalous = 0
+        # Whether the current part has already been counted as anomalous
+        self.flagged = False
+        self.times = {'run': 0.0, 'idle': 0.0, 'down': 0.0}
+        self.tail = np.empty(0)
+        # State and length of a run too short to decide yet
+        self.pending: Tuple[int, int] = None
+
+    def update(self, values: np.ndarray, rate: float, ts: np.ndarray = None) -> List[Tuple[int, int, int]]:
+        """Adds a batch of samples taken every rate seconds, with optional epoch-ns timestamps.
+        Returns the transitions as (sample index in the batch, negative if the new state began in an earlier
+        batch, or its timestamp if ts is given, old state, new state)."""
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return list()
+        window = max(1, int(round(self.smooth / rate)))
+        min_len = max(1, int(round(self.min_duration / rate)))
+        run_states, lengths = runs(classify(values, self.tail, window, self.idle_level, self.abnormal_level))
+        self.tail = np.concatenate((self.tail, values))[-(window - 1):] if window > 1 else np.empty(0)
+        offset = 0
+        if self.pending is not None:
+            # The held run starts before this batch
+            pending_state, offset = self.pending
+            self.pending = None
+            if run_states[0] == pending_state:
+                lengths[0] += offset
+            else:
+                run_states = np.concatenate(([pending_state], run_states))
+                lengths = np.concatenate(([offset], lengths))
+        starts = np.cumsum(lengths) - lengths - offset
+        decided = lengths >= min_len
+        if not decided[-1]:
+            earlier = np.flatnonzero(decided[:-1])
+            absorbed_into = run_states[earlier[-1]] if len(earlier) else self.state
+            if run_states[-1] != absorbed_into:
+                self.pending = (int(run_states[-1]), int(lengths[-1]))
+                run_states, lengths, starts, decided = run_states[:-1], lengths[:-1], starts[:-1], decided[:-1]
+        # Short runs take the state of the last long run before them
+        last_long = np.maximum.accumulate(np.where(decided, np.arange(len(decided)), -1))
+        previous = -1 if self.state is None else self.state
+        effective = np.where(last_long >= 0, run_states[np.maximum(last_long, 0)], previous)
+        if self.state is None:
+            # Nothing to absorb into at the very start
+            effective = np.where(effective < 0, run_states, effective)
+        counts = np.bincount(effective.astype(np.int64), weights=lengths, minlength=4) * rate
+        self.times['down'] += float(counts[STOP])
+        self.times['idle'] += float(counts[IDLE])
+        self.times['run'] += float(counts[NORMAL] + counts[ABNORMAL])
+        changes = np.flatnonzero(np.diff(np.concatenate(([previous], effective))))
+        transitions = list()
+        for i in changes:
+            new = int(effective[i])
+            if self.state == STOP:
+                self.parts += 1
+                self.flagged = False
+            if new == ABNORMAL and not self.flagged:
+                self.anomalous += 1
+                self.flagged = True
+            at = int(starts[i])
+            if ts is not None:
+                at = int(ts[at]) if at >= 0 else int(ts[0] + at * rate * 1e9)
+            transitions.append((at, self.state, new))
+            self.state = new
+        return transitions
+
+    @property
+    def state_name(self) -> str:
+        return None if self.state is None else STATE_NAMES[self.state]
+
+    def to_dict(self) -> dict:
+        return {'idle_level': self.idle_level, 'abnormal_level': self.abnormal_level, 'smooth': self.smooth,
+                'min_duration': self.min_duration, 'state': self.state, 'parts': self.parts,
+                'anomalous': self.anomalous, 'flagged': self.flagged, 'times': dict(self.times),
+                'tail': self.tail.tolist(), 'pending': self.pending}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'StateTracker':
+        tracker = cls(d['idle_level'], d['abnormal_level'], d['smooth'], d['min_duration'])
+        tracker.state = d['state']
+        tracker.parts = d['parts']
+        tracker.anomalous = d['anomalous']
+        tracker.flagged = d['flagged']
+        tracker.times = dict(d['times'])
+        tracker.tail = np.asarray(d['tail'], dtype=np.float64)
+        tracker.pending = tuple(d['pending']) if d['pending'] is not None else None
+        return tracker
@@ -0,0 +1,69 @@
+"""Compares per-second machine state classification with sample-resolution segmentation on power.csv.
+Usage: python segmentation_bench.py [sample rate]"""
+
+import sys
+from timeit import timeit
+
+import numpy as np
+
+from segmentation import StateTracker
+
+IDLE_LEVEL = 100
+ABNORMAL_LEVEL = 5800
+
+
+def per_second(values: np.ndarray, rate: float, n: int) -> dict:
+    """The dashboard's former logic: one state per batch of n samples from its mean, times from a second scan."""
+    state, count, anomalous, flag = None, 0, 0, False
+    times = {'run': 0.0, 'idle': 0.0, 'down': 0.0}
+    for ndx in range(0, len(values), n):
+        val_list = values[ndx:ndx + n]
+        average = np.mean(val_list)
+        if abs(average) < 1:
+            average = np.mean(val_list[val_list >= 0])
+        if average == 0:
+            new_state = 'MACHINE STOP'
+        elif average < IDLE_LEVEL:
+            new_state = 'MACHINE IDLE'
+        elif average > ABNORMAL_LEVEL:
+            new_state = 'ABNORMAL OPERATION'
+        else:
+            new_state = 'NORMAL OPERATION'
+        if state == 'MACHINE STOP' and new_state != 'MACHINE STOP':
+            count += 1
+            flag = False
+        if new_state == 'ABNORMAL OPERATION':
+            if not flag:
+                anomalous += 1
+            flag = True
+        state = new_state
+        run_c = len(val_list)
+        idle_c = np.count_nonzero(val_list < IDLE_LEVEL)
+        run_c -= idle_c
+        down_c = np.count_nonzero(val_list == 0)
+        idle_c -= down_c
+        times['run'] += run_c * rate
+        times['idle'] += idle_c * rate
+        times['down'] += down_c * rate
+    return {'state': state, 'parts': count, 'anomalous': anomalous, 'times': times}
+
+
+def segmented(values: np.ndarray, rate: float, n: int) -> dict:
+    tracker = StateTracker(IDLE_LEVEL, ABNORMAL_LEVEL)
+    for ndx in range(0, len(values), n):
+        tracker.update(values[ndx:ndx + n], rate)
+    return {'state': tracker.state_name, 'parts': tracker.parts, 'anomalous': tracker.anomalous,
+            'times': tracker.times}
+
+
+if __name__ == '__main__':
+    rate = 1 / (float(sys.argv[1]) if len(sys.argv) > 1 else 1024)
+    values = np.loadtxt('power.csv')
+    second = int(round(1 / rate))
+    for name, n in (('1 s batches', second), ('catch-up, one batch', len(values))):
+        for func in (per_second, segmented):
+            t = timeit(lambda: func(values, rate, n), number=20) / 20
+            result = func(values, rate, n)
+            times = {key: round(float(value), 3) for key, value in result['times'].items()}
+            print(f'{name:20} {func.__name__:10} {t * 1e3:8.3f} ms  {result["state"]}, '
+                  f'{result["parts"]} parts, {result["anomalous"]} anomalous, {times}')
@@ -0,0 +1,226 @@
+"""asyncio counterpart of smip_io2.SMIP built on aiohttp"""
+
+import asyncio
+import logging
+from datetime import datetime
+from time import time
+from typing import Dict, List, Tuple
+
+import aiohttp
+import numpy as np
+
+import smip_payload
+from smip_decode import HistoryDecoder
+from smip_io2 import (MUTATION_ADDDATA, MUTATION_CHALLENGE, MUTATION_CLEARDATA,
+                      MUTATION_TOKEN, QUERY_GETDATA, SMIP, TOKEN_SKEW,
+                      token_expiry)
+
+
+class AsyncSMIP:
+    """Async SMIP client. At most concurrency requests are in flight at once, sharing keep-alive connections.
+    Use as an async context manager, or call open() and close() from within the event loop.
+    Methods return the decoded JSON body instead of a Response.
+    """
+
+    def __init__(self, endpoint: str, authenticator: str, role: str, userName: str, password: str,
+                 concurrency: int = 8, keepalive_timeout: float = 30, refresh_margin: float = 60) -> None:
+        self.__endpoint = endpoint
+        self.__authenticator = authenticator
+        self.__role = role
+        self.__userName = userName
+        self.__password = password
+        self.__concurrency = concurrency
+        self.__keepalive_timeout = keepalive_timeout
+        self.__session: aiohttp.ClientSession = None
+        self.__semaphore: asyncio.Semaphore = None
+        # Seconds before expiry at which the token is refreshed in the background
+        self.refresh_margin = refresh_margin
+        self.__token_lock: asyncio.Lock = None
+        self.__token_exp = 0.0
+        self.__refresh_task: asyncio.Task = None
+        self.token: str = None
+
+    async def open(self) -> None:
+        """Creates the connection pool and gets an auth token."""
+        connector = aiohttp.TCPConnector(
+            limit=self.__concurrency, keepalive_timeout=self.__keepalive_timeout)
+        self.__session = aiohttp.ClientSession(connector=connector)
+        self.__semaphore = asyncio.Semaphore(self.__concurrency)
+        self.__token_lock = asyncio.Lock()
+        await self.refresh_token()
+
+    async def close(self) -> None:
+        """Stops the background token refresh and closes the connection pool."""
+        if self.__refresh_task is not None:
+            self.__refresh_task.cancel()
+            self.__refresh_task = None
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    async def __aenter__(self) -> 'AsyncSMIP':
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def __post(self, json: dict = None, data: bytes = None, auth: bool = True, timeout: float = None) -> dict:
+        """Posts to the endpoint once a concurrency slot is free, returns the decoded JSON body."""
+        headers = {"Content-Type": "application/json"}
+        if auth:
+            headers["Authorization"] = f"Bearer {self.token}"
+        async with self.__semaphore:
+            async with self.__session.post(self.__endpoint, json=json, data=data, headers=headers,
+                                           timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+                r.raise_for_status()
+                return await r.json()
+
+    async def get_token(self) -> str:
+        """Posts GraphQL mutations to get an auth token."""
+        r = await self.__post(json={
+            "query": MUTATION_CHALLENGE,
+            "variables": {
+                "authenticator": self.__authenticator,
+                "role": self.__role,
+                "userName": self.__userName
+            }
+        }, auth=False)
+        challenge = r['data']['authenticationRequest']['jwtRequest']['challenge']
+        r = await self.__post(json={
+            "query": MUTATION_TOKEN,
+            "variables": {
+                "authenticator": self.__authenticator,
+                "signedChallenge": challenge + '|' + self.__password
+            }
+        }, auth=False)
+        return r['data']['authenticationValidation']['jwtClaim']
+
+    async def update_token(self) -> bool:
+        """Helper function to check if a token is valid and updates it if not.
+        Returns True if token is valid, False if token was updated.
+        Only compares against the cached expiry, the token is normally refreshed in the background.
+        """
+        if time() < self.__token_exp - TOKEN_SKEW:
+            return True
+        await self.refresh_token()
+        return False
+
+    async def refresh_token(self) -> None:
+        """Gets a new token and schedules its background refresh. Concurrent callers share one refresh."""
+        seen_exp = self.__token_exp
+        async with self.__token_lock:
+            if self.__token_exp != seen_exp:
+                return
+            token = await self.get_token()
+            self.__token_exp = token_expiry(token)
+            self.token = token
+            lifetime = self.__token_exp - time()
+            if lifetime < float('inf'):
+                current = asyncio.current_task()
+                if self.__refresh_task is not None and self.__refresh_task is not current:
+                    self.__refresh_task.cancel()
+                self.__refresh_task = asyncio.ensure_future(self.__background_refresh(
+                    max(lifetime - self.refresh_margin, lifetime / 2, 0)))
+
+    async def __background_refresh(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        while True:
+            try:
+                await self.refresh_token()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.warning('Background token refresh failed', exc_info=True)
+                # Retry until the token expires, after which requests refresh inline
+                if time() >= self.__token_exp - TOKEN_SKEW:
+                    return
+                await asyncio.sleep(TOKEN_SKEW)
+
+    async def add_data(self, id: int, entries: List[dict], timeout: float = None) -> dict:
+        """Sends timeseries to SMIP."""
+        await self.update_token()
+        return await self.__post(json={
+            "query": MUTATION_ADDDATA,
+            "variables": {
+                "id": id,
+                "entries": entries
+            }
+        }, timeout=timeout)
+
+    async def add_data_raw(self, id: int, entries: str, timeout: float = None) -> dict:
+        """Sends timeseries already formatted as a JSON [TimeSeriesEntryInput] list to SMIP."""
+        await self.update_token()
+        return await self.__post(data=smip_payload.request_body(MUTATION_ADDDATA, id, entries), timeout=timeout)
+
+    async def add_data_async(self, id: int, entries: List[dict], timeout: float = None, n: int = 1000) -> List[dict]:
+        """Breaks up timeseries into chunks of n and uploads them concurrently, up to the concurrency limit."""
+        return await asyncio.gather(*(self.add_data(id, batch, timeout)
+                                      for batch in SMIP.batcher(entries, n)))
+
+    async def add_data_array(self, id: int, values: np.ndarray, startTime: datetime = None, freq: float = None,
+                             timestamps: np.ndarray = None, timeout: float = None, n: int = 1000) -> List[dict]:
+        """Uploads an array of values, timestamped either by a datetime64 array or by start time and frequency."""
+        values = np.asarray(values)
+        timestamps = smip_payload.resolve_timestamps(values, startTime, freq, timestamps)
+        return await asyncio.gather(*(self.add_data_raw(id, smip_payload.entries_json(
+            timestamps[ndx:ndx + n], values[ndx:ndx + n]), timeout) for ndx in range(0, len(values), n)))
+
+    async def clear_data(self, start_time: str, end_time: str, id: int, timeout: float = None) -> dict:
+        """Clears timeseries from SMIP."""
+        await self.update_token()
+        return await self.__post(json={
+            "query": MUTATION_CLEARDATA,
+            "variables": {
+                "endTime": end_time,
+                "startTime": start_time,
+                "id": id
+            }
+        }, timeout=timeout)
+
+    async def get_data(self, start_time: str, end_time: str, ids: List[int], timeout: float = None) -> dict:
+        """Gets timeseries from SMIP."""
+        await self.update_token()
+        return await self.__post(json={
+            "query": QUERY_GETDATA,
+            "variables": {
+                "endTime": end_time,
+                "startTime": start_time,
+                "ids": ids
+            }
+        }, timeout=timeout)
+
+    async def get_data_arrays(self, start_time: str, end_time: str, ids: List[int], timeout: float = None,
+                              chunk_size: int = 65536) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        """Gets timeseries from SMIP, decoding the response as it streams in. See SMIP.get_data_arrays."""
+        await self.update_token()
+        json = {
+            "query": QUERY_GETDATA,
+            "variables": {
+                "endTime": end_time,
+                "startTime": start_time,
+                "ids": ids
+            }
+        }
+        headers = {"Authorization": f"Bearer {self.token}"}
+        decoder = HistoryDecoder()
+        async with self.__semaphore:
+            async with self.__session.post(self.__endpoint, json=json, headers=headers,
+                                           timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+                r.raise_for_status()
+                async for chunk in r.content.iter_chunked(chunk_size):
+                    decoder.feed(chunk)
+        data = decoder.finish()
+        for id in ids:
+            data.setdefault(int(id), (np.empty(0, dtype=np.int64),
+                                      np.empty(0, dtype=np.float64)))
+        return data
+
+
+if __name__ == '__main__':
+    async def main():
+        async with AsyncSMIP("https://smtamu.cesmii.net/graphql", "test",
+                             "smtamu_group", "parthdave", "parth1234") as conn:
+            print(conn.token)
+    asyncio.run(main())
@@ -0,0 +1,114 @@
+"""Offline upload/download throughput benchmark against the local SMIP stand-in server.
+Usage: python smip_bench.py [output.csv] [latency seconds] [bandwidth bytes/s]"""
+
+import csv
+import sys
+from multiprocessing import Process
+from time import perf_counter, process_time, sleep
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+import requests
+
+import smip_stub
+from smip_io2 import SMIP
+
+START = pd.to_datetime('2021-07-20T00:00:00+00:00')
+END = pd.to_datetime('2021-07-21T00:00:00+00:00')
+ID = 5356
+PORT = 8910
+SIZES = [1000, 10000, 50000, 100000, 200000]
+REPEATS = 3
+FIELDS = ['Mode', 'Size',
+          'Upload throughput', 'Upload min', 'Upload median', 'Upload max', 'Upload CPU',
+          'Download throughput', 'Download min', 'Download median', 'Download max', 'Download CPU']
+
+
+def connect(endpoint: str, attempts: int = 50) -> SMIP:
+    """Connects once the server is accepting requests."""
+    for _ in range(attempts):
+        try:
+            return SMIP(endpoint, "test", "smtamu_group", "parthdave", "parth1234")
+        except requests.ConnectionError:
+            sleep(0.1)
+    raise requests.ConnectionError(f'Could not connect to {endpoint}')
+
+
+def upload(conn: SMIP, mode: str, samples: int) -> Dict[str, List[float]]:
+    """Runs one upload and one download of samples values, returns request latencies, wall times and CPU times."""
+    conn.clear_data(START.isoformat(), END.isoformat(), ID)
+    values = np.random.random(samples)
+    cpu_start = process_time()
+    upload_timer_start = perf_counter()
+    if mode == 'array':
+        resp_list = conn.add_data_array(ID, values, startTime=START,
+                                        freq=samples / (END - START).total_seconds())
+    elif mode == 'stream':
+        resp_list = conn.add_data_stream(ID, values, startTime=START,
+                                         freq=samples / (END - START).total_seconds())
+    else:
+        time_range = pd.date_range(start=START, end=END, periods=samples)
+        entries = [{'timestamp': ts.isoformat(), 'value': str(val), 'status': 0}
+                   for ts, val in zip(time_range, values)]
+        resp_list = conn.add_data_async(ID, entries)
+    upload_t = perf_counter() - upload_timer_start
+    upload_cpu = process_time() - cpu_start
+
+    cpu_start = process_time()
+    download_timer_start = perf_counter()
+    if mode != 'dict':
+        count = len(conn.get_data_arrays(
+            START.isoformat(), END.isoformat(), [ID])[ID][0])
+    else:
+        r = conn.get_data(START.isoformat(), END.isoformat(), [ID])
+        count = len(r.json()['data']['getRawHistoryDataWithSampling'])
+    download_t = perf_counter() - download_timer_start
+    download_cpu = process_time() - cpu_start
+    assert count == samples, f'{count} != {samples}'
+    return {'upload_latency': [r.elapsed.total_seconds() for r in resp_list],
+            'upload_time': [upload_t], 'upload_cpu': [upload_cpu],
+            'download_time': [download_t], 'download_cpu': [download_cpu]}
+
+
+def spread(name: str, times: List[float]) -> dict:
+    """Min, median and max of a few timings in seconds. Too few for meaningful tail percentiles."""
+    return {f'{name} min': round(float(np.min(times)), 4), f'{name} median': round(float(np.median(times)), 4),
+            f'{name} max': round(float(np.max(times)), 4)}
+
+
+def bench(conn: SMIP, mode: str, samples: int, repeats: int = REPEATS) -> dict:
+    """Repeats upload() and summarizes throughput (samples/s), min/median/max latency (s) and client CPU time (s)."""
+    runs: Dict[str, List[float]] = dict()
+    for _ in range(repeats):
+        for key, value in upload(conn, mode, samples).items():
+            runs.setdefault(key, []).extend(value)
+    return {'Mode': mode, 'Size': samples,
+            'Upload throughput': int(samples / np.mean(runs['upload_time'])),
+            **spread('Upload', runs['upload_latency']),
+            'Upload CPU': round(float(np.mean(runs['upload_cpu'])), 4),
+            'Download throughput': int(samples / np.mean(runs['download_time'])),
+            **spread('Download', runs['download_time']),
+            'Download CPU': round(float(np.mean(runs['download_cpu'])), 4)}
+
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'smip_bench.csv'
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    bandwidth = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    # Run the server in its own process so its CPU time is not counted
+    server = Process(target=smip_stub.serve, kwargs={'port': PORT, 'latency': latency,
+                                                     'bandwidth': bandwidth, 'background': False}, daemon=True)
+    server.start()
+    try:
+        conn = connect(f'http://127.0.0.1:{PORT}/graphql')
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            for size in SIZES:
+                for mode in ('dict', 'array', 'stream'):
+                    row = bench(conn, mode, size)
+                    writer.writerow(row)
+                    print(row)
+    finally:
+        server.terminate()
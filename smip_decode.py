@@ -0,0 +1,98 @@
+"""Incremental decoder for getRawHistoryDataWithSampling responses"""
+
+import json
+import re
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from strptime_fix import parse_timestamps
+
+ARRAY_START = re.compile(rb'"getRawHistoryDataWithSampling"\s*:\s*\[')
+FIELD_ID = re.compile(rb'"id"\s*:\s*"?(-?\d+)"?')
+FIELD_VALUE = re.compile(rb'"floatvalue"\s*:\s*([^,}\s]+)')
+FIELD_TS = re.compile(rb'"ts"\s*:\s*"([^"]*)"')
+
+
+def parse_ts(ts: np.ndarray) -> np.ndarray:
+    """Parses an array of SMIP timestamp bytes to epoch nanoseconds."""
+    return parse_timestamps(ts).view(np.int64)
+
+
+class HistoryDecoder:
+    """Decodes a response body fed in arbitrary chunks into per-tag columnar arrays.
+    Only complete records are decoded, so parsing can run while the rest of the body is in transit.
+    """
+
+    def __init__(self) -> None:
+        self.__buffer = bytearray()
+        self.__started = False
+        self.__done = False
+        self.__ts: Dict[int, List[np.ndarray]] = dict()
+        self.__values: Dict[int, List[np.ndarray]] = dict()
+        self.count = 0
+
+    def feed(self, chunk: bytes) -> None:
+        """Adds a chunk of the response body and decodes any complete records in it."""
+        if self.__done:
+            return
+        self.__buffer += chunk
+        if not self.__started:
+            match = ARRAY_START.search(self.__buffer)
+            if match is None:
+                return
+            del self.__buffer[:match.end()]
+            self.__started = True
+        # Records hold no arrays, so the first ']' closes the history array
+        end = self.__buffer.find(b']')
+        if end >= 0:
+            self.__done = True
+        else:
+            end = self.__buffer.rfind(b'}') + 1
+        region = bytes(self.__buffer[:end])
+        del self.__buffer[:end]
+        self.__decode(region)
+
+    def __decode(self, region: bytes) -> None:
+        """Decodes a run of complete records into arrays, grouped by tag ID."""
+        ids = FIELD_ID.findall(region)
+        values = FIELD_VALUE.findall(region)
+        ts = FIELD_TS.findall(region)
+        if not len(ids) == len(values) == len(ts):
+            raise ValueError('Malformed getRawHistoryDataWithSampling record')
+        if not ids:
+            return
+        id_arr = np.array(ids).astype(np.int64)
+        value_arr = np.array(values)
+        value_arr[value_arr == b'null'] = b'nan'
+        value_arr = value_arr.astype(np.float64)
+        ts_arr = parse_ts(np.array(ts))
+        for id in np.unique(id_arr):
+            mask = id_arr == id
+            self.__ts.setdefault(int(id), []).append(ts_arr[mask])
+            self.__values.setdefault(int(id), []).append(value_arr[mask])
+        self.count += len(ids)
+
+    def finish(self) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        """Returns a dict of tag ID to (epoch-ns int64 timestamps, float64 values).
+        Raises an Exception containing the body if it did not hold history data, e.g. GraphQL errors.
+        """
+        if not self.__started:
+            body = bytes(self.__buffer)
+            try:
+                response_json = json.loads(body)
+            except ValueError:
+                raise Exception(body[:1000])
+            raise Exception(response_json.get('errors', response_json))
+        if not self.__done:
+            raise ValueError('Truncated getRawHistoryDataWithSampling response')
+        return {id: (np.concatenate(self.__ts[id]), np.concatenate(self.__values[id]))
+                for id in self.__ts}
+
+    @classmethod
+    def decode(cls, chunks: Iterable[bytes]) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        """Decodes an iterable of body chunks."""
+        decoder = cls()
+        for chunk in chunks:
+            decoder.feed(chunk)
+        return decoder.finish()
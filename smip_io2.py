@@ -1,14 +1,27 @@
 """Rewrite of smip_io using a class"""
 
-from concurrent.futures import Future, as_completed
+import logging
+import threading
+from random import random
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from datetime import datetime
-from typing import List, cast
+from json import dumps
+from time import perf_counter, sleep, time
+from typing import Dict, Iterator, List, Tuple, cast
 
 import jwt
+import numpy as np
 import requests
 from pandas import date_range
 from requests_futures.sessions import FuturesSession
 
+import smip_metrics
+import smip_payload
+from smip_decode import HistoryDecoder
+from smip_metrics import Metrics
+from smip_resume import UploadJournal
+from smip_tune import UploadTuner
+
 # GraphQL mutation to generate a challenge for user
 MUTATION_CHALLENGE = """
 mutation Challenge($authenticator: String, $role: String, $userName: String) {
@@ -83,21 +96,106 @@ query GetData($startTime: Datetime, $endTime: Datetime, $ids: [BigInt]) {
 }
 """
 
+# Seconds before expiry at which a token is no longer used for new requests
+TOKEN_SKEW = 5
+
+
+def token_expiry(token: str) -> float:
+    """Returns the exp claim of a JWT as a UNIX timestamp, or infinity if it has none."""
+    claims = jwt.decode(token, algorithms="HS256",
+                        options={"verify_signature": False})
+    return float(claims.get('exp', float('inf')))
+
 
 class SMIP:
-    def __init__(self, endpoint: str, authenticator: str, role: str, userName: str, password: str) -> None:
+    def __init__(self, endpoint: str, authenticator: str, role: str, userName: str, password: str,
+                 refresh_margin: float = 60, metrics: Metrics = None) -> None:
         self.__endpoint = endpoint
         self.__session = requests.Session()
+        # Per-operation request timings, see smip_metrics
+        self.metrics = metrics or Metrics()
+        self.__session.mount('http://', smip_metrics.TimedAdapter())
+        self.__session.mount('https://', smip_metrics.TimedAdapter())
         self.__futureSession = FuturesSession(session=self.__session)
         self.__authenticator = authenticator
         self.__role = role
         self.__userName = userName
         self.__password = password
-        self.token = self.get_token()
+        # Seconds before expiry at which the token is refreshed in the background
+        self.refresh_margin = refresh_margin
+        self.__token_lock = threading.Lock()
+        self.__token_exp = 0.0
+        self.__refresh_timer: threading.Timer = None
+        self.token: str = None
+        self.refresh_token()
+        self.tuner = UploadTuner()
+
+    def __send(self, op: str, json: dict = None, data=None, headers: dict = None, timeout: float = None,
+               stream: bool = False, build: float = 0.0) -> Tuple[requests.Response, dict]:
+        """Posts to the endpoint, timing each phase of the request for metrics.
+        Unless stream is set the body is downloaded, decoded as JSON and the sample recorded under op,
+        otherwise the caller finishes the sample and records it."""
+        sample = {'build': build, 'sent': 0}
+        headers = dict(headers or {})
+        if json is not None:
+            start = perf_counter()
+            # Like requests 2.26 does for json=, NaN is written as NaN rather than rejected
+            data = dumps(json).encode()
+            sample['build'] += perf_counter() - start
+            headers.setdefault("Content-Type", "application/json")
+        if isinstance(data, bytes):
+            sample['sent'] = len(data)
+        elif data is not None:
+            data = self.__timed_body(data, sample)
+        smip_metrics.reset_connect()
+        start = perf_counter()
+        try:
+            r = self.__session.post(self.__endpoint, data=data, headers=headers, timeout=timeout, stream=True)
+            sample['connect'] = smip_metrics.connect_time()
+            # Building a streamed body overlaps with sending it
+            sample['wait'] = perf_counter() - start - sample['connect'] - (sample['build'] - build)
+            if stream:
+                return r, sample
+            start = perf_counter()
+            sample['received'] = len(r.content)
+            sample['download'] = perf_counter() - start
+            start = perf_counter()
+            try:
+                decoded = r.json()
+            except ValueError:
+                pass
+            else:
+                # Decoded once here so it is timed, later calls return the same object
+                r.json = lambda **kwargs: decoded
+                sample['decode'] = perf_counter() - start
+        except Exception:
+            sample.setdefault('connect', smip_metrics.connect_time())
+            self.metrics.record(op, sample, failed=True)
+            raise
+        self.metrics.record(op, sample, failed=not r.ok)
+        return r, sample
+
+    @staticmethod
+    def __timed_body(body: Iterator[bytes], sample: dict) -> Iterator[bytes]:
+        """Passes through a streamed body, adding the time spent building it and its size to sample."""
+        while True:
+            start = perf_counter()
+            chunk = next(body, None)
+            sample['build'] += perf_counter() - start
+            if chunk is None:
+                return
+            sample['sent'] += len(chunk)
+            yield chunk
+
+    def __post(self, op: str, async_mode: bool = False, **kwargs):
+        """Posts like __send, returning the Response, or a Future of it in async mode."""
+        if async_mode:
+            return self.__futureSession.executor.submit(lambda: self.__send(op, **kwargs)[0])
+        return self.__send(op, **kwargs)[0]
 
     def get_token(self) -> str:
         """Posts GraphQL mutations to get an auth token."""
-        r = self.__session.post(self.__endpoint, json={
+        r = self.__post('token', json={
             "query": MUTATION_CHALLENGE,
             "variables": {
                 "authenticator": self.__authenticator,
@@ -108,7 +206,7 @@ class SMIP:
         r.raise_for_status()
         challenge = r.json()[
             'data']['authenticationRequest']['jwtRequest']['challenge']
-        r = self.__session.post(self.__endpoint, json={
+        r = self.__post('token', json={
             "query": MUTATION_TOKEN,
             "variables": {
                 "authenticator": self.__authenticator,
@@ -122,19 +220,54 @@ class SMIP:
     def update_token(self) -> bool:
         """Helper function to check if a token is valid and updates it if not.
         Returns True if token is valid, False if token was updated.
+        Only compares against the cached expiry, the token is normally refreshed in the background.
         """
-        try:
-            jwt.decode(self.token, algorithms="HS256", options={
-                "verify_signature": False, "verify_exp": True})
+        if time() < self.__token_exp - TOKEN_SKEW:
             return True
-        except:
-            self.token = self.get_token()
-            return False
+        self.refresh_token()
+        return False
+
+    def refresh_token(self) -> None:
+        """Gets a new token and schedules its background refresh.
+        Concurrent callers share one refresh: whoever waited on it returns once the new token is set.
+        """
+        seen_exp = self.__token_exp
+        with self.__token_lock:
+            if self.__token_exp != seen_exp:
+                return
+            token = self.get_token()
+            self.__token_exp = token_expiry(token)
+            self.token = token
+            if self.__refresh_timer is not None:
+                self.__refresh_timer.cancel()
+            lifetime = self.__token_exp - time()
+            if lifetime < float('inf'):
+                self.__schedule_refresh(
+                    max(lifetime - self.refresh_margin, lifetime / 2, 0))
+
+    def __schedule_refresh(self, delay: float) -> None:
+        self.__refresh_timer = threading.Timer(delay, self.__background_refresh)
+        self.__refresh_timer.daemon = True
+        self.__refresh_timer.start()
+
+    def __background_refresh(self) -> None:
+        try:
+            self.refresh_token()
+        except Exception:
+            logging.warning('Background token refresh failed', exc_info=True)
+            # Retry until the token expires, after which requests refresh inline
+            if time() < self.__token_exp - TOKEN_SKEW:
+                self.__schedule_refresh(TOKEN_SKEW)
+
+    def close(self) -> None:
+        """Stops the background token refresh and closes connections."""
+        if self.__refresh_timer is not None:
+            self.__refresh_timer.cancel()
+        self.__futureSession.close()
 
     def add_data(self, id: int, entries: List[dict], timeout: float = None, async_mode: bool = False) -> requests.Response:
         """Sends timeseries to SMIP."""
         self.update_token()
-        s = self.__futureSession if async_mode else self.__session
         json = {
             "query": MUTATION_ADDDATA,
             "variables": {
@@ -143,9 +276,17 @@ class SMIP:
             }
         }
         headers = {"Authorization": f"Bearer {self.token}"}
-        r = s.post(
-            self.__endpoint, json=json, headers=headers, timeout=timeout)
-        return r
+        return self.__post('add_data', async_mode, json=json, headers=headers, timeout=timeout)
+
+    def add_data_raw(self, id: int, entries: str, timeout: float = None, async_mode: bool = False) -> requests.Response:
+        """Sends timeseries already formatted as a JSON [TimeSeriesEntryInput] list to SMIP."""
+        self.update_token()
+        headers = {"Authorization": f"Bearer {self.token}",
+                   "Content-Type": "application/json"}
+        start = perf_counter()
+        body = smip_payload.request_body(MUTATION_ADDDATA, id, entries)
+        return self.__post('add_data', async_mode, data=body, headers=headers, timeout=timeout,
+                           build=perf_counter() - start)
 
     @staticmethod
     def batcher(toSplit, n: int = 1000):
@@ -173,6 +314,56 @@ class SMIP:
             r.raise_for_status()
         return resp_list
 
+    def add_data_adaptive(self, id: int, entries: List[dict], timeout: float = None, tuner: UploadTuner = None,
+                          retries: int = 3) -> List[requests.Response]:
+        """Uploads in windows of concurrent batches, tuning batch size and concurrency from the measured
+        throughput of each window. Batches that time out are split up and retried. Returns a list of Responses.
+        The tuner, self.tuner by default, keeps the chosen settings and throughput history for the caller.
+        """
+        if tuner is None:
+            tuner = self.tuner
+        if timeout is not None:
+            tuner.latency_limit = min(tuner.latency_limit, timeout / 2)
+        resp_list = list()
+        failed_batches: List[List[dict]] = list()
+        # Consecutive failed windows
+        attempts = 0
+        pos = 0
+        while pos < len(entries) or failed_batches:
+            # Fill a window with retried batches first, then fresh ones
+            window = list()
+            while len(window) < tuner.concurrency and (failed_batches or pos < len(entries)):
+                if failed_batches:
+                    window.append(failed_batches.pop())
+                else:
+                    window.append(entries[pos:pos + tuner.batch_size])
+                    pos += tuner.batch_size
+            window_start = perf_counter()
+            post = [(batch, self.add_data(id, batch, timeout, async_mode=True))
+                    for batch in window]
+            samples = 0
+            max_latency = 0.0
+            failed = False
+            for batch, future in post:
+                try:
+                    r = cast(requests.Response, future.result())
+                except (requests.ConnectionError, requests.Timeout):
+                    failed = True
+                    half = max(1, len(batch) // 2)
+                    failed_batches += [batch[:half], batch[half:]] if len(batch) > 1 else [batch]
+                    continue
+                r.raise_for_status()
+                resp_list.append(r)
+                samples += len(batch)
+                max_latency = max(max_latency, r.elapsed.total_seconds())
+            tuner.update(samples, perf_counter() - window_start,
+                         max_latency, failed)
+            attempts = attempts + 1 if failed else 0
+            if attempts > retries:
+                raise requests.ConnectionError(
+                    f'Upload failed after {retries} retries')
+        return resp_list
+
     def add_data_from_ts(self, id: int, entries: List, startTime: datetime, freq: float, timeout: float = None, async_mode=True) -> List[requests.Response]:
         """Calculates timestamps from start time and frequency, then uploads. Returns a list of Responses."""
         add = self.add_data_async if async_mode else self.add_data_serial
@@ -183,6 +374,100 @@ class SMIP:
                  'status': 0} for ts, val in zip(time_range, entries)]
         return add(id=id, entries=data, timeout=timeout)
 
+    def add_data_array(self, id: int, values: np.ndarray, startTime: datetime = None, freq: float = None,
+                       timestamps: np.ndarray = None, timeout: float = None, async_mode=True) -> List[requests.Response]:
+        """Uploads an array of values, timestamped either by a datetime64 array or by start time and frequency.
+        Each batch is formatted in one vectorized pass without building per-sample dicts. Returns a list of Responses."""
+        values = np.asarray(values)
+        timestamps = smip_payload.resolve_timestamps(values, startTime, freq, timestamps)
+        n = 1000 if async_mode else 8000
+        resp_list = [self.add_data_raw(id, smip_payload.entries_json(timestamps[ndx:ndx + n], values[ndx:ndx + n]),
+                                       timeout, async_mode=async_mode)
+                     for ndx in range(0, len(values), n)]
+        if async_mode:
+            resp_list = [cast(requests.Response, future.result())
+                         for future in as_completed(cast(List[Future], resp_list))]
+        for r in resp_list:
+            r.raise_for_status()
+        return resp_list
+
+    def add_data_stream(self, id: int, values: np.ndarray, startTime: datetime = None, freq: float = None,
+                        timestamps: np.ndarray = None, timeout: float = None, n: int = None,
+                        chunk: int = 8192) -> List[requests.Response]:
+        """Uploads an array of values like add_data_array, but streams each request body chunk by chunk
+        instead of building it in memory. Sends one request per n values, or a single request if n is None.
+        Returns a list of Responses."""
+        if timestamps is not None and len(timestamps) != len(values):
+            raise ValueError(
+                f'Got {len(timestamps)} timestamps but {len(values)} values')
+        n = n or max(len(values), 1)
+        headers = {"Content-Type": "application/json"}
+        resp_list = list()
+        for ndx in range(0, len(values), n):
+            self.update_token()
+            headers["Authorization"] = f"Bearer {self.token}"
+            body = smip_payload.request_stream(
+                MUTATION_ADDDATA, id, values[ndx:ndx + n], startTime, freq,
+                None if timestamps is None else timestamps[ndx:ndx + n], chunk, offset=ndx)
+            r = self.__post('add_data', data=body, headers=headers, timeout=timeout)
+            r.raise_for_status()
+            resp_list.append(r)
+        return resp_list
+
+    def add_data_resumable(self, id: int, values: np.ndarray, journal: str, startTime: datetime = None, freq: float = None,
+                           timestamps: np.ndarray = None, timeout: float = None, n: int = 1000, retries: int = 5,
+                           backoff: float = 1.0) -> List[requests.Response]:
+        """Uploads like add_data_array, recording each acknowledged chunk in the journal file.
+        Rerunning the same upload with the same journal only sends the chunks that were not acknowledged.
+        Transient failures (connection errors, timeouts, HTTP 429/5xx and GraphQL errors) are retried
+        with exponential backoff. The journal is removed once everything is uploaded. Returns a list of Responses.
+        """
+        values = np.asarray(values)
+        timestamps = smip_payload.resolve_timestamps(values, startTime, freq, timestamps)
+        header = {'id': id, 'count': len(values)}
+        if len(values):
+            header.update(first=str(timestamps[0]), last=str(timestamps[-1]))
+        progress = UploadJournal(journal, header)
+        pending = progress.missing(len(values), n)
+        resp_list = list()
+        attempt = 0
+        try:
+            while pending:
+                post = {self.add_data_raw(id, smip_payload.entries_json(timestamps[start:end], values[start:end]),
+                                          timeout, async_mode=True): (start, end) for start, end in pending}
+                failed = list()
+                for future in as_completed(post):
+                    start, end = post[future]
+                    try:
+                        r = cast(requests.Response, future.result())
+                        if r.status_code == 429 or r.status_code >= 500:
+                            raise requests.ConnectionError(
+                                f'HTTP {r.status_code}', response=r)
+                        r.raise_for_status()
+                        errors = r.json().get('errors')
+                        if errors:
+                            raise requests.ConnectionError(errors, response=r)
+                    except (requests.ConnectionError, requests.Timeout) as e:
+                        failed.append((start, end))
+                        error = e
+                        continue
+                    progress.ack(start, end)
+                    resp_list.append(r)
+                pending = failed
+                if pending:
+                    attempt += 1
+                    if attempt > retries:
+                        raise error
+                    delay = backoff * 2 ** (attempt - 1) * (0.5 + random())
+                    logging.warning('%s chunks failed (%s), retrying in %s seconds',
+                                    len(pending), error, round(delay, 3))
+                    sleep(delay)
+        except BaseException:
+            progress.close()
+            raise
+        progress.close(remove=True)
+        return resp_list
+
     def clear_data(self, start_time: str, end_time: str, id: int, timeout: float = None) -> requests.Response:
         """Clears timeseries from SMIP."""
         self.update_token()
@@ -195,8 +480,7 @@ class SMIP:
             }
         }
         headers = {"Authorization": f"Bearer {self.token}"}
-        r = self.__session.post(
-            self.__endpoint, json=json, headers=headers, timeout=timeout)
+        r = self.__post('clear_data', json=json, headers=headers, timeout=timeout)
         r.raise_for_status()
         return r
 
@@ -212,11 +496,96 @@ class SMIP:
             }
         }
         headers = {"Authorization": f"Bearer {self.token}"}
-        r = self.__session.post(
-            self.__endpoint, json=json, headers=headers, timeout=timeout)
+        r = self.__post('get_data', json=json, headers=headers, timeout=timeout)
         r.raise_for_status()
         return r
 
+    def get_data_arrays(self, start_time: str, end_time: str, ids: List[int], timeout: float = None,
+                        chunk_size: int = 65536) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        """Gets timeseries from SMIP, decoding the response as it streams in.
+        Returns a dict of tag ID to (epoch-ns int64 timestamps, float64 values), including the
+        sample SMIP returns before the start time. Tags without data map to empty arrays.
+        """
+        self.update_token()
+        json = {
+            "query": QUERY_GETDATA,
+            "variables": {
+                "endTime": end_time,
+                "startTime": start_time,
+                "ids": ids
+            }
+        }
+        headers = {"Authorization": f"Bearer {self.token}"}
+        r, sample = self.__send('get_data', json=json, headers=headers, timeout=timeout, stream=True)
+        sample.update(received=0, download=0.0, decode=0.0)
+        try:
+            with r:
+                r.raise_for_status()
+                decoder = HistoryDecoder()
+                chunks = r.iter_content(chunk_size)
+                while True:
+                    start = perf_counter()
+                    chunk = next(chunks, None)
+                    sample['download'] += perf_counter() - start
+                    if chunk is None:
+                        break
+                    sample['received'] += len(chunk)
+                    start = perf_counter()
+                    decoder.feed(chunk)
+                    sample['decode'] += perf_counter() - start
+                start = perf_counter()
+                data = decoder.finish()
+                sample['decode'] += perf_counter() - start
+        except Exception:
+            self.metrics.record('get_data', sample, failed=True)
+            raise
+        self.metrics.record('get_data', sample)
+        for id in ids:
+            data.setdefault(int(id), (np.empty(0, dtype=np.int64),
+                                      np.empty(0, dtype=np.float64)))
+        return data
+
+    def get_data_sharded(self, start_time: str, end_time: str, ids: List[int], shards: int = 4,
+                         ids_per_query: int = 1, fan_out: int = 8,
+                         timeout: float = None) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        """Gets timeseries like get_data_arrays, splitting the time range into shards and the ids into
+        groups of ids_per_query, and running up to fan_out of the sub-queries concurrently.
+        Only the first shard keeps the sample SMIP returns before the start time, and samples on
+        a boundary between shards are only kept once."""
+        start = smip_payload.to_datetime64(start_time).astype('datetime64[us]').astype(np.int64)
+        end = smip_payload.to_datetime64(end_time).astype('datetime64[us]').astype(np.int64)
+        # Shard boundaries in whole microseconds, the resolution of SMIP timestamps
+        bounds = np.unique(np.round(np.linspace(start, end, max(shards, 1) + 1)).astype(np.int64))
+        if len(bounds) == 1:
+            bounds = np.repeat(bounds, 2)
+        text = np.char.add(np.datetime_as_string(bounds.astype('datetime64[us]'), unit='us'), '+00:00')
+        groups = [tuple(ids[ndx:ndx + ids_per_query]) for ndx in range(0, len(ids), ids_per_query)]
+        group_of = {int(id): group for group in groups for id in group}
+        with ThreadPoolExecutor(max_workers=fan_out) as executor:
+            futures = {(shard, group): executor.submit(self.get_data_arrays, text[shard], text[shard + 1],
+                                                       list(group), timeout)
+                       for shard in range(len(bounds) - 1) for group in groups}
+            results = {key: future.result() for key, future in futures.items()}
+        data = dict()
+        for id in ids:
+            ts_parts, value_parts = list(), list()
+            for shard in range(len(bounds) - 1):
+                ts, values = results[(shard, group_of[int(id)])][int(id)]
+                keep = np.ones(len(ts), dtype=bool)
+                if shard > 0:
+                    keep &= ts >= bounds[shard] * 1000
+                if shard < len(bounds) - 2:
+                    keep &= ts < bounds[shard + 1] * 1000
+                ts_parts.append(ts[keep])
+                value_parts.append(values[keep])
+            ts, values = np.concatenate(ts_parts), np.concatenate(value_parts)
+            order = np.argsort(ts, kind='stable')
+            ts, values = ts[order], values[order]
+            unique = np.ones(len(ts), dtype=bool)
+            unique[1:] = ts[1:] != ts[:-1]
+            data[int(id)] = (ts[unique], values[unique])
+        return data
+
 
 if __name__ == '__main__':
     conn = SMIP("https://smtamu.cesmii.net/graphql", "test",
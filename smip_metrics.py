@@ -0,0 +1,170 @@
+"""Per-request timing and byte counts for the SMIP client, with a Prometheus text exporter"""
+
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Callable, Dict, List
+
+import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Phases of a request, in seconds
+PHASES = ('build', 'connect', 'wait', 'download', 'decode')
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+_local = threading.local()
+
+
+def reset_connect() -> None:
+    """Starts counting connect time for a request on this thread."""
+    _local.connect = 0.0
+
+
+def connect_time() -> float:
+    """Seconds spent opening connections on this thread since reset_connect()."""
+    return getattr(_local, 'connect', 0.0)
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self) -> None:
+        start = perf_counter()
+        try:
+            super().connect()
+        finally:
+            _local.connect = connect_time() + perf_counter() - start
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self) -> None:
+        start = perf_counter()
+        try:
+            super().connect()
+        finally:
+            _local.connect = connect_time() + perf_counter() - start
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedAdapter(HTTPAdapter):
+    """Transport adapter whose connections record how long connecting (including TLS) took."""
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool,
+                                                   'https': TimedHTTPSConnectionPool}
+
+
+class OperationStats:
+    """Totals for one operation since start, plus the latencies of the last window requests."""
+
+    def __init__(self, window: int) -> None:
+        self.count = 0
+        self.failed = 0
+        self.sent = 0
+        self.received = 0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.latency = 0.0
+        # Cumulative bucket counts, as Prometheus histograms expect
+        self.buckets = [0] * len(BUCKETS)
+        self.recent: deque = deque(maxlen=window)
+
+
+class Metrics:
+    """Collects request samples per operation. A sample is a dict with the seconds spent in each of PHASES
+    (missing phases count as zero) and the bytes sent and received. Every hook is called with the
+    operation name and the sample, which also gets its total latency and whether it failed.
+    """
+
+    def __init__(self, window: int = 1024) -> None:
+        self.window = window
+        self.hooks: List[Callable[[str, dict], None]] = list()
+        self.__lock = threading.Lock()
+        self.__ops: Dict[str, OperationStats] = dict()
+
+    def record(self, op: str, sample: dict, failed: bool = False) -> None:
+        latency = sum(sample.get(phase, 0.0) for phase in PHASES)
+        sample = dict(sample, latency=latency, failed=failed)
+        with self.__lock:
+            stats = self.__ops.get(op)
+            if stats is None:
+                stats = self.__ops[op] = OperationStats(self.window)
+            stats.count += 1
+            stats.failed += failed
+            stats.sent += sample.get('sent', 0)
+            stats.received += sample.get('received', 0)
+            for phase in PHASES:
+                stats.phases[phase] += sample.get(phase, 0.0)
+            stats.latency += latency
+            for i, bound in enumerate(BUCKETS):
+                if latency <= bound:
+                    stats.buckets[i] += 1
+            stats.recent.append(latency)
+        for hook in self.hooks:
+            hook(op, sample)
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Returns the totals of each operation and the p50/p90/p99 latency of its recent requests."""
+        with self.__lock:
+            ops = {op: (stats.count, stats.failed, stats.sent, stats.received, dict(stats.phases),
+                        np.array(stats.recent)) for op, stats in self.__ops.items()}
+        snapshot = dict()
+        for op, (count, failed, sent, received, phases, recent) in ops.items():
+            p50, p90, p99 = np.percentile(recent, [50, 90, 99]) if len(recent) else (0.0, 0.0, 0.0)
+            snapshot[op] = {'count': count, 'failed': failed, 'sent': sent, 'received': received,
+                            **phases, 'p50': float(p50), 'p90': float(p90), 'p99': float(p99)}
+        return snapshot
+
+    def prometheus(self) -> str:
+        """Formats the totals and latency histograms in the Prometheus text exposition format."""
+        with self.__lock:
+            ops = sorted(self.__ops.items())
+            lines = list()
+            for name, attr in (('smip_requests_total', 'count'), ('smip_request_failures_total', 'failed'),
+                               ('smip_sent_bytes_total', 'sent'), ('smip_received_bytes_total', 'received')):
+                lines.append(f'# TYPE {name} counter')
+                lines.extend(f'{name}{{op="{op}"}} {getattr(stats, attr)}' for op, stats in ops)
+            lines.append('# TYPE smip_phase_seconds_total counter')
+            for op, stats in ops:
+                lines.extend(f'smip_phase_seconds_total{{op="{op}",phase="{phase}"}} {seconds}'
+                             for phase, seconds in stats.phases.items())
+            lines.append('# TYPE smip_request_seconds histogram')
+            for op, stats in ops:
+                for bound, count in zip(BUCKETS, stats.buckets):
+                    le = '+Inf' if bound == float('inf') else bound
+                    lines.append(f'smip_request_seconds_bucket{{op="{op}",le="{le}"}} {count}')
+                lines.append(f'smip_request_seconds_sum{{op="{op}"}} {stats.latency}')
+                lines.append(f'smip_request_seconds_count{{op="{op}"}} {stats.count}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int = 9108, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        """Serves prometheus() at /metrics from a background thread, returns the server."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
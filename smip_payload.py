@@ -0,0 +1,142 @@
+"""Vectorized formatting of TimeSeriesEntryInput payloads for SMIP uploads"""
+
+import json
+import mmap
+import os
+from typing import Iterator
+
+import numpy as np
+from pandas import Timestamp
+
+# Text surrounding each formatted TimeSeriesEntryInput object
+ENTRY_PREFIX = '{"timestamp":"'
+ENTRY_MIDDLE = '+00:00","value":"'
+ENTRY_SUFFIX = '","status":0}'
+# Byte templates for streamed request bodies
+ENTRY_PREFIX_B = ENTRY_PREFIX.encode()
+ENTRY_MIDDLE_B = ENTRY_MIDDLE.encode()
+ENTRY_SEPARATOR_B = (ENTRY_SUFFIX + ',').encode()
+ENTRY_SUFFIX_B = ENTRY_SUFFIX.encode()
+
+
+def to_datetime64(ts) -> np.datetime64:
+    """Converts a datetime or ISO 8601 string to a UTC datetime64[ns]. Naive times are treated as UTC."""
+    ts = Timestamp(ts)
+    if ts.tzinfo is not None:
+        ts = ts.tz_convert('UTC').tz_localize(None)
+    return ts.to_datetime64().astype('datetime64[ns]')
+
+
+def timestamps_from_rate(start_time, freq: float, n: int, offset: int = 0) -> np.ndarray:
+    """Returns n datetime64[ns] timestamps at freq Hz starting at sample offset after start_time.
+    Timestamps are computed from the sample index, so no rounding error accumulates."""
+    step = 1e9 / freq
+    index = np.arange(offset, offset + n, dtype=np.float64)
+    return to_datetime64(start_time) + np.round(index * step).astype('timedelta64[ns]')
+
+
+def resolve_timestamps(values: np.ndarray, start_time=None, freq: float = None, timestamps: np.ndarray = None) -> np.ndarray:
+    """Returns timestamps as datetime64[ns], computing them from start_time and freq if not given."""
+    if timestamps is None:
+        if start_time is None or freq is None:
+            raise ValueError('Either timestamps or startTime and freq are required')
+        timestamps = timestamps_from_rate(start_time, freq, len(values))
+    timestamps = np.asarray(timestamps, dtype='datetime64[ns]')
+    if len(timestamps) != len(values):
+        raise ValueError(
+            f'Got {len(timestamps)} timestamps but {len(values)} values')
+    return timestamps
+
+
+def format_timestamps(timestamps: np.ndarray) -> np.ndarray:
+    """Formats UTC datetime64 timestamps to ISO 8601 strings (without offset) in one pass."""
+    return np.datetime_as_string(np.asarray(timestamps, dtype='datetime64[us]'), unit='us')
+
+
+def format_values(values: np.ndarray) -> np.ndarray:
+    """Formats values to their shortest round-trip string representation in one pass."""
+    values = np.asarray(values)
+    if values.dtype.kind in 'SU':
+        return np.char.strip(values.astype(str))
+    return values.astype(np.float64).astype(str)
+
+
+def entries_json(timestamps: np.ndarray, values: np.ndarray) -> str:
+    """Formats timestamps and values into the JSON text of a [TimeSeriesEntryInput] list."""
+    if len(timestamps) != len(values):
+        raise ValueError(
+            f'Got {len(timestamps)} timestamps but {len(values)} values')
+    if len(values) == 0:
+        return '[]'
+    parts = np.char.add(np.char.add(ENTRY_PREFIX, format_timestamps(timestamps)),
+                        np.char.add(ENTRY_MIDDLE, format_values(values)))
+    return '[' + (ENTRY_SUFFIX + ',').join(parts.tolist()) + ENTRY_SUFFIX + ']'
+
+
+def request_head(query: str, id: int) -> str:
+    """Returns the start of a GraphQL request body, up to where the entries go."""
+    return ''.join((
+        '{"query":', json.dumps(query),
+        ',"variables":{"id":', json.dumps(id),
+        ',"entries":'
+    ))
+
+
+def request_body(query: str, id: int, entries: str) -> bytes:
+    """Wraps preformatted entries JSON into a GraphQL request body."""
+    return (request_head(query, id) + entries + '}}').encode()
+
+
+def request_stream(query: str, id: int, values: np.ndarray, start_time=None, freq: float = None,
+                   timestamps: np.ndarray = None, chunk: int = 8192, offset: int = 0) -> Iterator[bytes]:
+    """Yields a GraphQL request body for values chunk by chunk, timestamped either by a datetime64 array
+    or by start time and frequency, with the first value offset samples after the start time.
+    Only one chunk of entries is ever formatted at a time, so values and timestamps can be memory-mapped
+    arrays much larger than memory."""
+    if timestamps is None:
+        if start_time is None or freq is None:
+            raise ValueError('Either timestamps or startTime and freq are required')
+    elif len(timestamps) != len(values):
+        raise ValueError(
+            f'Got {len(timestamps)} timestamps but {len(values)} values')
+    yield (request_head(query, id) + '[').encode()
+    for ndx in range(0, len(values), chunk):
+        chunk_values = values[ndx:ndx + chunk]
+        if timestamps is None:
+            chunk_ts = timestamps_from_rate(start_time, freq, len(chunk_values), offset + ndx)
+        else:
+            chunk_ts = timestamps[ndx:ndx + chunk]
+        parts = np.char.add(np.char.add(ENTRY_PREFIX_B, format_timestamps(chunk_ts).astype(bytes)),
+                            np.char.add(ENTRY_MIDDLE_B, format_values(chunk_values).astype(bytes)))
+        yield (b',' if ndx else b'') + ENTRY_SEPARATOR_B.join(parts.tolist()) + ENTRY_SUFFIX_B
+    yield b']}}'
+
+
+def load_values(file) -> np.ndarray:
+    """Reads a single column of values from a text file."""
+    with open(file, 'rb') as f:
+        return np.array(f.read().split()).astype(np.float64)
+
+
+def iter_values(file, chunk_bytes: int = 2 ** 22, columns: int = 1) -> Iterator[np.ndarray]:
+    """Reads a text file of comma or whitespace separated numbers chunk by chunk through a memory map,
+    splitting chunks on line ends. Yields float64 arrays of shape (rows,) or (rows, columns) if columns > 1."""
+    with open(file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            pos = 0
+            while pos < size:
+                end = min(pos + chunk_bytes, size)
+                if end < size:
+                    # Extend to the end of the last whole line, or of the line if it is longer than a chunk
+                    newline = m.rfind(b'\n', pos, end)
+                    end = newline + 1 if newline >= 0 else (m.find(b'\n', end) + 1 or size)
+                data = m[pos:end]
+                pos = end
+                if columns > 1:
+                    data = data.replace(b',', b' ')
+                values = np.array(data.split()).astype(np.float64)
+                if len(values):
+                    yield values.reshape(-1, columns) if columns > 1 else values
@@ -0,0 +1,68 @@
+"""On-disk journal of acknowledged upload chunks, so interrupted uploads can be resumed"""
+
+import json
+import os
+from typing import List, Tuple
+
+
+class UploadJournal:
+    """Append-only journal for one upload job. The first line is a JSON header identifying the job,
+    each following line is the [start, end) range of entries SMIP acknowledged.
+    A journal whose header does not match the job is discarded.
+    """
+
+    def __init__(self, path: str, header: dict) -> None:
+        self.path = path
+        self.header = header
+        self.acked: List[Tuple[int, int]] = list()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                lines = f.read().splitlines()
+            if lines and json.loads(lines[0]) == header:
+                # A torn last line from a crash is ignored
+                for line in lines[1:]:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        self.acked.append((int(parts[0]), int(parts[1])))
+        self.__file = open(path, 'a' if self.acked else 'w')
+        if not self.acked:
+            self.__file.write(json.dumps(header) + '\n')
+            self.__sync()
+
+    @staticmethod
+    def read_header(path: str) -> dict:
+        """Returns the header of an existing journal, or None."""
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            line = f.readline()
+        try:
+            return json.loads(line)
+        except ValueError:
+            return None
+
+    def __sync(self) -> None:
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+
+    def ack(self, start: int, end: int) -> None:
+        """Durably records that entries [start, end) were uploaded."""
+        self.acked.append((start, end))
+        self.__file.write(f'{start} {end}\n')
+        self.__sync()
+
+    def missing(self, count: int, n: int) -> List[Tuple[int, int]]:
+        """Returns the unacknowledged ranges of [0, count), split into chunks of at most n."""
+        chunks = list()
+        pos = 0
+        for start, end in sorted(self.acked) + [(count, count)]:
+            for ndx in range(pos, min(start, count), n):
+                chunks.append((ndx, min(ndx + n, start, count)))
+            pos = max(pos, end)
+        return chunks
+
+    def close(self, remove: bool = False) -> None:
+        """Closes the journal, removing it if the job is finished."""
+        self.__file.close()
+        if remove:
+            os.remove(self.path)
@@ -0,0 +1,181 @@
+"""Local stand-in for the SMIP GraphQL endpoint, for offline testing and benchmarking.
+Implements the operations used by smip_io2 with configurable latency and bandwidth."""
+
+import json
+import secrets
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+from typing import Dict, Tuple
+
+import jwt
+import numpy as np
+
+from strptime_fix import parse_timestamps
+
+SECRET = 'smip-stub-signing-key-for-local-testing'
+TOKEN_TTL = 1800
+CHUNK_SIZE = 65536
+
+
+class TimeSeriesStore:
+    """Thread-safe in-memory store of sorted (epoch-ns timestamps, values) per tag ID."""
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__data: Dict[int, Tuple[np.ndarray, np.ndarray]] = dict()
+
+    def __get(self, id: int) -> Tuple[np.ndarray, np.ndarray]:
+        return self.__data.get(id, (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)))
+
+    def replace(self, id: int, start: int, end: int, ts: np.ndarray = None, values: np.ndarray = None) -> None:
+        """Removes samples in [start, end] and inserts the given samples."""
+        with self.__lock:
+            old_ts, old_values = self.__get(id)
+            keep = (old_ts < start) | (old_ts > end)
+            new_ts, new_values = old_ts[keep], old_values[keep]
+            if ts is not None and len(ts):
+                new_ts = np.concatenate((new_ts, ts))
+                new_values = np.concatenate((new_values, values))
+                order = np.argsort(new_ts, kind='stable')
+                new_ts, new_values = new_ts[order], new_values[order]
+            self.__data[id] = (new_ts, new_values)
+
+    def query(self, id: int, start: int, end: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns samples in [start, end], plus the sample before start like SMIP does."""
+        with self.__lock:
+            ts, values = self.__get(id)
+        lo = max(0, int(np.searchsorted(ts, start, 'left')) - 1)
+        hi = int(np.searchsorted(ts, end, 'right'))
+        return ts[lo:hi], values[lo:hi]
+
+
+def format_ts(ts: np.ndarray) -> np.ndarray:
+    """Formats epoch-ns timestamps like SMIP does, dropping the fraction when it is zero."""
+    text = np.datetime_as_string(ts.view('datetime64[ns]').astype('datetime64[us]'), unit='us')
+    text = np.char.replace(text, '.000000', '')
+    return np.char.add(text, '+00:00')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Set on the handler class by serve()
+    store: TimeSeriesStore = None
+    latency = 0.0
+    bandwidth = 0.0
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def __throttle(self, size: int) -> None:
+        if self.bandwidth:
+            sleep(size / self.bandwidth)
+
+    def __read_body(self) -> bytes:
+        """Reads a Content-Length or chunked request body."""
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return bytes(body)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+                self.__throttle(size)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.__throttle(len(body))
+        return body
+
+    def __respond(self, body: bytes) -> None:
+        sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        for ndx in range(0, len(body), CHUNK_SIZE):
+            chunk = body[ndx:ndx + CHUNK_SIZE]
+            self.__throttle(len(chunk))
+            self.wfile.write(chunk)
+
+    def __authorized(self) -> bool:
+        token = self.headers.get('Authorization', '')[len('Bearer '):]
+        try:
+            jwt.decode(token, SECRET, algorithms='HS256')
+            return True
+        except jwt.PyJWTError:
+            return False
+
+    def do_POST(self) -> None:
+        request = json.loads(self.__read_body())
+        query: str = request['query']
+        variables: dict = request.get('variables', {})
+        if 'authenticationRequest' in query:
+            body = {'data': {'authenticationRequest': {
+                'jwtRequest': {'challenge': secrets.token_hex(16)}}}}
+        elif 'authenticationValidation' in query:
+            token = jwt.encode({'role': 'smtamu_group', 'exp': int(time()) + TOKEN_TTL},
+                               SECRET, algorithm='HS256')
+            body = {'data': {'authenticationValidation': {'jwtClaim': token}}}
+        elif not self.__authorized():
+            body = {'errors': [{'message': 'jwt expired'}], 'data': None}
+        elif 'replaceTimeSeriesRange' in query:
+            body = self.__replace(variables)
+        elif 'getRawHistoryDataWithSampling' in query:
+            self.__respond(self.__history(variables))
+            return
+        else:
+            body = {'errors': [{'message': 'Unsupported operation'}], 'data': None}
+        self.__respond(json.dumps(body).encode())
+
+    def __replace(self, variables: dict) -> dict:
+        id = int(variables['id'])
+        entries = variables.get('entries')
+        if entries:
+            ts = parse_timestamps([e['timestamp'] for e in entries]).view(np.int64)
+            values = np.array([e['value'] for e in entries], dtype=np.float64)
+            order = np.argsort(ts, kind='stable')
+            ts, values = ts[order], values[order]
+            self.store.replace(id, ts[0], ts[-1], ts, values)
+        else:
+            start, end = parse_timestamps(
+                [variables['startTime'], variables['endTime']]).view(np.int64)
+            self.store.replace(id, start, end)
+        return {'data': {'replaceTimeSeriesRange': {'json': '{}'}}}
+
+    def __history(self, variables: dict) -> bytes:
+        start, end = parse_timestamps(
+            [variables['startTime'], variables['endTime']]).view(np.int64)
+        records = list()
+        for id in variables['ids']:
+            ts, values = self.store.query(int(id), start, end)
+            if not len(ts):
+                continue
+            values = np.where(np.isnan(values), 'null', values.astype(str))
+            parts = np.char.add(np.char.add('{"floatvalue":', values), ',"ts":"')
+            parts = np.char.add(np.char.add(parts, format_ts(ts)), f'","id":"{id}"}}')
+            records.append(','.join(parts.tolist()))
+        return ('{"data":{"getRawHistoryDataWithSampling":[' + ','.join(records) + ']}}').encode()
+
+
+def serve(port: int = 8910, latency: float = 0.0, bandwidth: float = 0.0, host: str = '127.0.0.1',
+          background: bool = True) -> ThreadingHTTPServer:
+    """Starts a stand-in server. latency is added seconds per response, bandwidth is bytes per second (0 for unlimited)."""
+    handler = type('Handler', (StubHandler,), {
+        'store': TimeSeriesStore(), 'latency': latency, 'bandwidth': bandwidth})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        server.serve_forever()
+    return server
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8910
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    bandwidth = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    print(f'Serving on http://127.0.0.1:{port}/graphql')
+    serve(port, latency, bandwidth, background=False)
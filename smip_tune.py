@@ -0,0 +1,64 @@
+"""Runtime tuning of upload batch size and concurrency"""
+
+from typing import List, Tuple
+
+
+class UploadTuner:
+    """Hill climbs batch size and request concurrency to maximize samples per second.
+    Each window of concurrent batches is measured; a setting is kept while throughput improves,
+    otherwise the best known setting is restored and the other parameter is explored.
+    Failed windows, or windows slower than latency_limit, halve the batch size and drop concurrency.
+    """
+
+    def __init__(self, batch_size: int = 1000, concurrency: int = 4, min_batch: int = 250, max_batch: int = 32000,
+                 max_concurrency: int = 8, latency_limit: float = 5, tolerance: float = 0.05) -> None:
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.max_concurrency = max_concurrency
+        self.latency_limit = latency_limit
+        self.tolerance = tolerance
+        # Samples per second of the last window and the best window since the last failure
+        self.throughput = 0.0
+        self.best_throughput = 0.0
+        self.__best = (batch_size, concurrency)
+        self.__tuning_batch = True
+        # (batch size, concurrency, samples per second, max latency) of each window
+        self.history: List[Tuple[int, int, float, float]] = list()
+
+    def update(self, samples: int, elapsed: float, max_latency: float, failed: bool = False) -> None:
+        """Records a window of uploads and picks the settings for the next window."""
+        self.throughput = samples / elapsed if elapsed > 0 else 0.0
+        self.history.append(
+            (self.batch_size, self.concurrency, self.throughput, max_latency))
+        if failed or max_latency > self.latency_limit:
+            self.batch_size = max(self.min_batch, self.batch_size // 2)
+            self.concurrency = max(1, self.concurrency - 1)
+            self.best_throughput = 0.0
+            self.__best = (self.batch_size, self.concurrency)
+            return
+        if self.throughput > self.best_throughput * (1 + self.tolerance):
+            self.best_throughput = self.throughput
+            self.__best = (self.batch_size, self.concurrency)
+        else:
+            self.batch_size, self.concurrency = self.__best
+            self.__tuning_batch = not self.__tuning_batch
+        self.__grow()
+
+    def __grow(self) -> None:
+        """Probes a larger value of the parameter being tuned, or the other one if it is at its limit."""
+        if self.__tuning_batch and self.batch_size >= self.max_batch:
+            self.__tuning_batch = False
+        elif not self.__tuning_batch and self.concurrency >= self.max_concurrency:
+            self.__tuning_batch = True
+        if self.__tuning_batch:
+            self.batch_size = min(self.max_batch, int(self.batch_size * 1.5))
+        else:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+
+    def settings(self) -> dict:
+        """Returns the best settings found so far and their measured throughput."""
+        return {'batch_size': self.__best[0],
+                'concurrency': self.__best[1],
+                'throughput': self.best_throughput}
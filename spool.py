@@ -0,0 +1,202 @@
+"""Write-ahead spool of sample blocks on local disk, so acquisition never waits on SMIP"""
+
+import logging
+import mmap
+import os
+import struct
+import threading
+from time import monotonic
+from typing import List, Tuple
+
+import numpy as np
+
+# Record header: tag id, epoch-ns timestamp of the first sample, sampling period in seconds, sample count
+HEADER = struct.Struct('<qqdq')
+SUFFIX = '.seg'
+
+
+class Spool:
+    """Append-only spool of (tag, t0, step, values) blocks in fixed-size memory-mapped segment files.
+    A record's header is written after its values, so a record torn by a crash reads as the end of the segment.
+    The read position is persisted by commit(), so a restart replays everything not yet acknowledged.
+    Once the spool holds more than max_bytes, the oldest segment is dropped, unread or not.
+    """
+
+    def __init__(self, directory: str, segment_size: int = 2 ** 26, max_bytes: int = 2 ** 30) -> None:
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__maps = dict()
+        self.__segments = sorted(int(name[:-len(SUFFIX)]) for name in os.listdir(directory)
+                                 if name.endswith(SUFFIX))
+        self.__cursor_path = os.path.join(directory, 'cursor')
+        self.__cursor = self.__read_cursor()
+        if not self.__segments:
+            self.__segments.append(0)
+        # Writing resumes after the last complete record
+        self.__write_pos = self.__scan(self.__segments[-1])
+        # Segments dropped unread, and the bytes of uncommitted records they held
+        self.dropped = 0
+        self.dropped_bytes = 0
+        # Throughput counters, rates are samples per second
+        self.written = 0
+        self.drained = 0
+        self.write_rate = 0.0
+        self.drain_rate = 0.0
+        self.__write_mark = self.__drain_mark = (monotonic(), 0)
+
+    def __path(self, segment: int) -> str:
+        return os.path.join(self.directory, f'{segment:012d}{SUFFIX}')
+
+    def __map(self, segment: int) -> mmap.mmap:
+        m = self.__maps.get(segment)
+        if m is None:
+            path = self.__path(segment)
+            with open(path, 'r+b' if os.path.exists(path) else 'w+b') as f:
+                if os.fstat(f.fileno()).st_size < self.segment_size:
+                    f.truncate(self.segment_size)
+                m = mmap.mmap(f.fileno(), self.segment_size)
+            self.__maps[segment] = m
+        return m
+
+    def __read_cursor(self) -> Tuple[int, int]:
+        try:
+            with open(self.__cursor_path, 'r') as f:
+                segment, offset = (int(x) for x in f.read().split())
+        except (OSError, ValueError):
+            segment, offset = (self.__segments[0] if self.__segments else 0), 0
+        if self.__segments and segment < self.__segments[0]:
+            segment, offset = self.__segments[0], 0
+        return segment, offset
+
+    def __scan(self, segment: int) -> int:
+        """Returns the offset after the last complete record of a segment."""
+        m = self.__map(segment)
+        pos = 0
+        while pos + HEADER.size <= self.segment_size:
+            n = HEADER.unpack_from(m, pos)[3]
+            if n <= 0:
+                break
+            pos += HEADER.size + 8 * n
+        return pos
+
+    def __drop_oldest(self) -> None:
+        segment = self.__segments.pop(0)
+        end = self.__scan(segment)
+        m = self.__maps.pop(segment, None)
+        if m is not None:
+            m.close()
+        os.remove(self.__path(segment))
+        if self.__cursor[0] <= segment:
+            self.dropped += 1
+            self.dropped_bytes += end - (self.__cursor[1] if self.__cursor[0] == segment else 0)
+            logging.warning('Spool full, dropped segment %s', segment)
+            self.__cursor = (self.__segments[0], 0)
+
+    @staticmethod
+    def __mark(mark: Tuple[float, int], total: int, rate: float) -> Tuple[Tuple[float, int], float]:
+        """Updates a rate from the samples counted since mark, at most once a second."""
+        now = monotonic()
+        if now - mark[0] < 1:
+            return mark, rate
+        return (now, total), (total - mark[1]) / (now - mark[0])
+
+    def append(self, tag: int, t0: int, step: float, values: np.ndarray) -> None:
+        """Durably appends a block of evenly spaced samples starting at epoch-ns time t0."""
+        values = np.ascontiguousarray(values, dtype='<f8')
+        size = HEADER.size + values.nbytes
+        if size + HEADER.size > self.segment_size:
+            raise ValueError(f'Block of {len(values)} samples does not fit in a segment')
+        with self.__lock:
+            # Leave room for a zero header marking the end
+            if self.__write_pos + size + HEADER.size > self.segment_size:
+                self.__maps[self.__segments[-1]].flush()
+                self.__segments.append(self.__segments[-1] + 1)
+                self.__write_pos = 0
+                while len(self.__segments) * self.segment_size > self.max_bytes and len(self.__segments) > 1:
+                    self.__drop_oldest()
+            m = self.__map(self.__segments[-1])
+            pos = self.__write_pos
+            m[pos + HEADER.size:pos + size] = values.tobytes()
+            # Clear whatever a torn record left where the next header goes
+            m[pos + size:pos + size + HEADER.size] = bytes(HEADER.size)
+            HEADER.pack_into(m, pos, tag, t0, step, len(values))
+            m.flush()
+            self.__write_pos += size
+            self.written += len(values)
+            self.__write_mark, self.write_rate = self.__mark(self.__write_mark, self.written, self.write_rate)
+
+    def read(self, max_samples: int = 2 ** 16) -> Tuple[List[Tuple[int, int, float, np.ndarray]], Tuple[int, int]]:
+        """Returns unread records totalling at most max_samples (but at least one record if any),
+        and the position to pass to commit() once they are uploaded."""
+        records = list()
+        with self.__lock:
+            segment, pos = self.__cursor
+            total = 0
+            while True:
+                end = self.__write_pos if segment == self.__segments[-1] else self.segment_size
+                if pos + HEADER.size > end:
+                    n = 0
+                else:
+                    m = self.__map(segment)
+                    tag, t0, step, n = HEADER.unpack_from(m, pos)
+                if n <= 0:
+                    if segment == self.__segments[-1]:
+                        break
+                    segment, pos = segment + 1, 0
+                    continue
+                if records and total + n > max_samples:
+                    break
+                values = np.frombuffer(m, dtype='<f8', count=n, offset=pos + HEADER.size).copy()
+                records.append((tag, t0, step, values))
+                total += n
+                pos += HEADER.size + 8 * n
+        return records, (segment, pos)
+
+    def commit(self, position: Tuple[int, int]) -> None:
+        """Marks everything before position as uploaded and removes fully read segments."""
+        with self.__lock:
+            if position[0] < self.__segments[0]:
+                # The records were dropped while they were being uploaded
+                return
+            drained = self.__count(self.__cursor, position)
+            self.__cursor = position
+            tmp = self.__cursor_path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(f'{position[0]} {position[1]}')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.__cursor_path)
+            while self.__segments[0] < position[0]:
+                self.__drop_oldest()
+            self.drained += drained
+            self.__drain_mark, self.drain_rate = self.__mark(self.__drain_mark, self.drained, self.drain_rate)
+
+    def __count(self, start: Tuple[int, int], end: Tuple[int, int]) -> int:
+        """Counts the samples between two positions."""
+        segment, pos = start
+        total = 0
+        while (segment, pos) < end:
+            n = HEADER.unpack_from(self.__map(segment), pos)[3] if pos + HEADER.size <= self.segment_size else 0
+            if n <= 0:
+                segment, pos = segment + 1, 0
+                continue
+            total += n
+            pos += HEADER.size + 8 * n
+        return total
+
+    @property
+    def backlog(self) -> int:
+        """Bytes written but not yet committed, including record headers."""
+        with self.__lock:
+            segment, pos = self.__cursor
+            return (self.__segments[-1] - segment) * self.segment_size + self.__write_pos - pos
+
+    def close(self) -> None:
+        with self.__lock:
+            for m in self.__maps.values():
+                m.flush()
+                m.close()
+            self.__maps.clear()
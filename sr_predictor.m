@@ -1,6 +1,17 @@
 function y = sr_predictor(feed_rate, wheel_speed, work_speed, power, Acc_n, Acc_t)
 
-    load("D:\Kerry\python\randomforestmodel\rforestmodel.mat", 'mdl');
+    % Load the model once per engine and keep it warm between calls
+    persistent mdl
+    if isempty(mdl)
+        model = load(fullfile(fileparts(mfilename('fullpath')), 'randomforestmodel', 'rforestmodel.mat'), 'mdl');
+        mdl = model.mdl;
+    end
+    % Called without arguments to warm up the engine
+    if nargin == 0
+        y = 0;
+        return
+    end
+
     Power_analysis = power;
 
     f1 = max(Power_analysis); %Max
@@ -0,0 +1,77 @@
+"""Pool of warm MATLAB engines serving surface roughness predictions off the callback thread"""
+
+import itertools
+import logging
+import threading
+from concurrent.futures import Future
+from time import monotonic
+from typing import Optional, Tuple
+
+import matlab.engine
+import numpy as np
+
+from offload import OffloadPool
+
+# The MATLAB engine of this worker process
+_engine = None
+
+
+def start_engine() -> None:
+    """Starts a MATLAB engine in a worker process and loads the model."""
+    global _engine
+    _engine = matlab.engine.start_matlab()
+    _engine.sr_predictor(nargout=1)
+
+
+def predict(feed_rate: float, wheel_speed: float, work_speed: float, power: np.ndarray, acc_n: np.ndarray,
+            acc_t: np.ndarray) -> float:
+    """Runs sr_predictor on this worker's engine, converting the samples to MATLAB arrays here."""
+    return float(_engine.sr_predictor(feed_rate, wheel_speed, work_speed, matlab.double(power.tolist()),
+                                      matlab.double(acc_n.tolist()), matlab.double(acc_t.tolist())))
+
+
+class PredictorPool:
+    """Runs sr_predictor in worker processes that each have a MATLAB engine with the model loaded.
+    submit() returns immediately; the most recent finished prediction and its latency are kept in latest.
+    A prediction is dropped rather than queued if every engine is busy and one is already waiting, and
+    a prediction finishing after a newer one, or after timeout seconds, is discarded.
+    """
+
+    def __init__(self, size: int = 2, timeout: float = 10.0) -> None:
+        self.size = size
+        self.timeout = timeout
+        self.pool = OffloadPool(size, max_queue=1, initializer=start_engine)
+        self.__lock = threading.Lock()
+        self.__submitted = itertools.count()
+        self.__latest_seq = -1
+        # (prediction, latency in seconds) of the last finished prediction
+        self.latest: Optional[Tuple[float, float]] = None
+        # Start engines in parallel
+        self.pool.start()
+
+    @property
+    def dropped(self) -> int:
+        stats = self.pool.snapshot().get('surface_roughness')
+        return 0 if stats is None else stats['dropped'] + stats['skipped'] + stats['late']
+
+    def submit(self, *args) -> Optional[Future]:
+        """Queues a prediction with predict's arguments, returns its Future or None if dropped."""
+        seq = next(self.__submitted)
+        submitted = monotonic()
+        future = self.pool.submit('surface_roughness', predict, *args, timeout=self.timeout)
+        if future is not None:
+            future.add_done_callback(lambda f: self.__finished(seq, submitted, f))
+        return future
+
+    def __finished(self, seq: int, submitted: float, future: Future) -> None:
+        if future.exception() is not None or future.result() is None:
+            return
+        with self.__lock:
+            if seq < self.__latest_seq:
+                return
+            self.__latest_seq = seq
+            self.latest = (future.result(), monotonic() - submitted)
+        logging.info('Surface roughness %s predicted in %s seconds', *self.latest)
+
+    def close(self) -> None:
+        self.pool.close()
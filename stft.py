@@ -0,0 +1,103 @@
+"""Incremental short-time Fourier transform with a rolling spectrogram history"""
+
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import signal
+
+
+def spectrum(values: np.ndarray, rate: float, skip: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the frequencies and FFT magnitudes of samples taken every rate seconds, from bin skip up."""
+    return np.fft.rfftfreq(len(values), d=rate)[skip:], np.abs(np.fft.rfft(values))[skip:]
+
+
+def power_spectra(buf: np.ndarray, nperseg: int, step: int, window: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    """Returns the (time, frequency) power of every whole frame of nperseg samples in buf, step apart."""
+    frames = sliding_window_view(buf, nperseg)[::step]
+    frames = frames - frames.mean(axis=1, keepdims=True)
+    return np.abs(np.fft.rfft(frames * window, axis=1)) ** 2 * scale
+
+
+class RollingSTFT:
+    """Computes spectrogram columns as samples arrive, carrying the unfinished frame over to the next push.
+    Columns match scipy.signal.spectrogram (constant detrend, density scaling, one-sided) and are kept for
+    the last history seconds. Frames start on multiples of the hop from the UNIX epoch, so separate
+    instances fed the same samples produce columns at the same times.
+    """
+
+    def __init__(self, fs: float, nperseg: int, window='hann', noverlap: int = None, history: float = 60) -> None:
+        self.fs = fs
+        self.nperseg = nperseg
+        self.noverlap = nperseg // 8 if noverlap is None else noverlap
+        self.step = nperseg - self.noverlap
+        self.freqs = np.fft.rfftfreq(nperseg, 1 / fs)
+        self.max_columns = max(1, int(history * fs / self.step))
+        self.__window = signal.get_window(window, nperseg)
+        self.__scale = np.full(len(self.freqs), 1 / (fs * (self.__window ** 2).sum()))
+        # One-sided density doubles every bin except DC and Nyquist
+        self.__scale[1:len(self.freqs) - (nperseg % 2 == 0)] *= 2
+        self.__tail = np.empty(0)
+        self.__tail_start = 0
+        self.__last_ts = None
+        self.__times = np.empty(0, dtype=np.int64)
+        self.__columns = np.empty((0, len(self.freqs)))
+
+    @property
+    def last_ts(self) -> Optional[int]:
+        """Epoch-ns timestamp of the last sample pushed, or None before the first push."""
+        return None if self.__last_ts is None else int(self.__last_ts)
+
+    def push(self, ts: np.ndarray, values: np.ndarray, compute: Callable = None) -> int:
+        """Adds samples with epoch-ns timestamps ts, returns the number of new columns.
+        Samples not newer than the last one pushed are ignored, a gap restarts the frame.
+        compute(power_spectra, *args) runs the FFTs if given, e.g. in another process. If it returns None
+        the samples are skipped, as if they were never pushed."""
+        tail, tail_start = self.__tail, self.__tail_start
+        if self.__last_ts is not None:
+            newer = ts > self.__last_ts
+            ts, values = ts[newer], values[newer]
+            if len(ts) and ts[0] - self.__last_ts > 1.5e9 / self.fs:
+                tail = np.empty(0)
+        if not len(ts):
+            return 0
+        last_ts = ts[-1]
+        if not len(tail):
+            # Align the first frame to the hop grid
+            skip = int(-round(int(ts[0]) * self.fs / 1e9) % self.step)
+            ts, values = ts[skip:], values[skip:]
+            if not len(ts):
+                self.__last_ts = last_ts
+                return 0
+            tail_start = int(ts[0])
+        buf = np.concatenate((tail, values))
+        if len(buf) < self.nperseg:
+            self.__tail, self.__tail_start, self.__last_ts = buf, tail_start, last_ts
+            return 0
+        args = (buf, self.nperseg, self.step, self.__window, self.__scale)
+        spec = power_spectra(*args) if compute is None else compute(power_spectra, *args)
+        if spec is None:
+            return 0
+        n = len(spec)
+        times = tail_start + np.round(
+            (np.arange(n) * self.step + self.nperseg / 2) * 1e9 / self.fs).astype(np.int64)
+        consumed = n * self.step
+        self.__tail = buf[consumed:]
+        self.__tail_start = tail_start + int(round(consumed * 1e9 / self.fs))
+        self.__last_ts = last_ts
+        self.__times = np.concatenate((self.__times, times))[-self.max_columns:]
+        self.__columns = np.concatenate((self.__columns, spec))[-self.max_columns:]
+        return n
+
+    def history(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the epoch-ns times and (time, frequency) power of every kept column."""
+        return self.__times, self.__columns
+
+    def since(self, t: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the columns after epoch-ns time t."""
+        start = int(np.searchsorted(self.__times, t, 'right'))
+        return self.__times[start:], self.__columns[start:]
+
+    def covers(self, t: int) -> bool:
+        """Whether every column after epoch-ns time t is still kept."""
+        return len(self.__times) > 0 and self.__times[0] - t <= self.step * 1e9 / self.fs * 1.5
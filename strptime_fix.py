@@ -1,5 +1,10 @@
 from datetime import datetime
 
+import numpy as np
+
+# Longest timestamp accepted by parse_timestamps, with nanoseconds and offset
+WIDTH = 35
+
 
 def strptime_fix(ts: str) -> datetime:
     '''Temporary fix for missing microsecond field in GraphQL response.'''
@@ -10,3 +15,46 @@ def strptime_fix(ts: str) -> datetime:
     else:
         raise ValueError('Unrecognized timestamp: ' + ts)
     return datetime.strptime(ts, fmt)
+
+
+def parse_timestamps(ts) -> np.ndarray:
+    '''Parses a list or array of SMIP timestamps to a UTC datetime64[ns] array in one vectorized pass.
+    Accepts timestamps with or without fractional seconds, ending in a +HH:MM/-HH:MM offset or Z.'''
+    arr = np.asarray(ts)
+    if arr.dtype.kind != 'S':
+        arr = arr.astype('S')
+    n = len(arr)
+    if n == 0:
+        return np.empty(0, dtype='datetime64[ns]')
+    if arr.dtype.itemsize > WIDTH:
+        raise ValueError('Unrecognized timestamp: ' + str(arr[np.char.str_len(arr) > WIDTH][0]))
+    # One row of ASCII codes per timestamp, zero padded on the right
+    buf = arr.astype(f'S{WIDTH}').view(np.uint8).reshape(n, WIDTH)
+    rows = np.arange(n)
+    lengths = np.count_nonzero(buf, axis=1)
+    zulu = buf[rows, lengths - 1] == ord('Z')
+    body_end = np.clip(np.where(zulu, lengths - 1, lengths - 6), 0, WIDTH - 6)
+    sign = buf[rows, body_end]
+    frac_len = np.clip(body_end - 20, 0, 9)
+    valid = (zulu | (sign == ord('+')) | (sign == ord('-'))) \
+        & (buf[:, 10] == ord('T')) \
+        & ((body_end == 19) | ((body_end > 20) & (body_end <= 29) & (buf[:, 19] == ord('.'))))
+    # Fractional seconds, right padded to nanoseconds
+    digits = buf[:, 20:29].astype(np.int64) - ord('0')
+    cols = np.arange(9)
+    in_frac = cols < frac_len[:, None]
+    valid &= np.all(~in_frac | ((digits >= 0) & (digits <= 9)), axis=1)
+    # UTC offset digits and separator, unless the timestamp ends in Z
+    offset_digits = buf[rows[:, None], body_end[:, None] + [1, 2, 4, 5]].astype(np.int64) - ord('0')
+    valid &= zulu | (np.all((offset_digits >= 0) & (offset_digits <= 9), axis=1)
+                     & (buf[rows, body_end + 3] == ord(':')) & (offset_digits[:, 2] <= 5))
+    if not valid.all():
+        raise ValueError('Unrecognized timestamp: ' + arr[~valid][0].decode())
+    frac = np.where(in_frac, digits, 0) @ (10 ** (8 - cols))
+    # UTC offset in minutes
+    hours = offset_digits[:, 0] * 10 + offset_digits[:, 1]
+    minutes = offset_digits[:, 2] * 10 + offset_digits[:, 3]
+    offset = np.where(zulu, 0, np.where(sign == ord('-'), -1, 1) * (hours * 60 + minutes))
+    base = np.ascontiguousarray(buf[:, :19]).view('S19').ravel().astype('datetime64[s]')
+    return base.astype('datetime64[ns]') + frac.astype('timedelta64[ns]') \
+        - offset.astype('timedelta64[m]')
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from downsample import minmax_indices, window_budget
+
+POINTS = 1000
+
+
+@pytest.mark.parametrize('n, keep_last', [(5000, 1024), (50000, 40000), (200000, 40000), (3000, 2000)])
+def test_window_longer_than_keep_last_is_bounded(n, keep_last):
+    y = np.sin(np.arange(n) / 7.0)
+    y[n // 3] = 10
+    budget = window_budget(n, keep_last, POINTS)
+    assert budget <= min(POINTS, keep_last)
+    index = minmax_indices(y, budget)
+    assert len(index) <= budget
+    assert n // 3 in index
+
+
+def test_short_windows_get_their_share():
+    assert window_budget(400, 40000, POINTS) == 10
+    assert window_budget(1, 40000, POINTS) == 4
+    # Nothing to downsample while the graph keeps fewer samples than POINTS
+    assert window_budget(100, 500, POINTS) == 100
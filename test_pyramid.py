@@ -0,0 +1,53 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+from pyramid import AggregatePyramid
+from ringbuffer import SharedRing
+
+RING = f'smip_test_ring_{os.getpid()}'
+
+
+def lead(name: str, start: int, n: int) -> None:
+    """Appends n samples a millisecond apart from epoch-ns start, as the polling process does."""
+    ring = SharedRing(name, 1024)
+    ts = start + np.arange(n, dtype=np.int64) * 10 ** 6
+    ring.append(ts, np.arange(n, dtype=np.float64))
+    ring.close()
+
+
+@pytest.fixture
+def ring():
+    ring = SharedRing(RING, 1024)
+    yield ring
+    ring.close()
+    ring.unlink()
+
+
+def run_leader(*args) -> None:
+    process = multiprocessing.get_context('spawn').Process(target=lead, args=(RING, *args))
+    process.start()
+    process.join(30)
+    assert process.exitcode == 0
+
+
+def test_follower_sees_data_the_leader_appended(ring):
+    follower = AggregatePyramid()
+    run_leader(10 ** 18, 100)
+    assert follower.follow(5366, ring) == 100
+    run_leader(10 ** 18 + 10 ** 8, 100)
+    assert follower.follow(5366, ring) == 100
+    buckets = follower.query(5366, 10 ** 18, 10 ** 18 + 2 * 10 ** 8)
+    assert buckets['count'].sum() == 200
+    assert buckets['min'].min() == 0 and buckets['max'].max() == 99
+    assert follower.last(5366) == 10 ** 18 + 199 * 10 ** 6
+
+
+def test_follow_adds_nothing_twice(ring):
+    follower = AggregatePyramid()
+    run_leader(10 ** 18, 50)
+    follower.follow(5366, ring)
+    assert follower.follow(5366, ring) == 0
+    assert follower.query(5366, 10 ** 18, 10 ** 18 + 10 ** 8)['count'].sum() == 50
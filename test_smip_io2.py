@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+import smip_stub
+from smip_io2 import SMIP
+
+PORT = 8941
+ID = 5366
+
+
+@pytest.fixture(scope='module')
+def conn():
+    server = smip_stub.serve(PORT)
+    yield SMIP(f'http://127.0.0.1:{PORT}/graphql', 'test', 'smtamu_group', 'parthdave', 'parth1234')
+    server.shutdown()
+
+
+def test_nan_values_are_sent_as_before(conn):
+    # NaN is serialized as NaN, as requests 2.26 does, rather than raising before sending
+    r = conn.add_data(ID, [{'timestamp': '2021-07-20T00:00:00+00:00', 'value': float('nan'), 'status': 0}])
+    assert r.ok
+
+
+def test_decode_is_timed_for_every_json_operation(conn):
+    conn.refresh_token()
+    conn.add_data(ID, [{'timestamp': '2021-07-20T00:00:01+00:00', 'value': '1.0', 'status': 0}])
+    r = conn.get_data('2021-07-20T00:00:00+00:00', '2021-07-20T00:00:02+00:00', [ID])
+    snapshot = conn.metrics.snapshot()
+    for op in ('token', 'add_data', 'get_data'):
+        assert snapshot[op]['decode'] > 0
+    # The decoded body is kept, not decoded again
+    assert r.json() is r.json()
+    assert len(r.json()['data']['getRawHistoryDataWithSampling']) >= 1
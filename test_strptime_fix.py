@@ -0,0 +1,30 @@
+from datetime import timezone
+
+import numpy as np
+import pytest
+
+from strptime_fix import parse_timestamps, strptime_fix
+
+VALID = ['2021-07-20T01:02:03+00:00', '2021-07-20T01:02:03.5-05:30', '2021-07-20T01:02:03.123456789+09:00',
+         '2021-07-20T01:02:03Z', '2021-07-20T01:02:03.25Z']
+
+
+def test_matches_strptime():
+    expected = [np.datetime64(strptime_fix(ts).astimezone(timezone.utc).replace(tzinfo=None), 'ns')
+                for ts in VALID[:2]]
+    assert parse_timestamps(VALID[:2]).tolist() == [ts.tolist() for ts in expected]
+
+
+def test_offsets_and_fractions():
+    parsed = parse_timestamps(VALID)
+    assert parsed.tolist() == np.array(['2021-07-20T01:02:03', '2021-07-20T06:32:03.5',
+                                        '2021-07-19T16:02:03.123456789', '2021-07-20T01:02:03',
+                                        '2021-07-20T01:02:03.25'], dtype='datetime64[ns]').tolist()
+
+
+@pytest.mark.parametrize('ts', ['2021-07-20T01:02:03+0a:00', '2021-07-20T01:02:03+05-00',
+                                '2021-07-20T01:02:03+05:0x', '2021-07-20T01:02:03.5+05:60',
+                                '2021-07-20T01:02:03 05:00', '2021-07-20T01:02:03+ 5:00'])
+def test_malformed_offsets(ts):
+    with pytest.raises(ValueError):
+        parse_timestamps([VALID[0], ts])
@@ -0,0 +1,192 @@
+"""Read-through on-disk cache of SMIP history in fixed time blocks"""
+
+import json
+import os
+import threading
+from time import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import smip_payload
+from smip_io2 import SMIP
+
+
+def _ns(ts) -> int:
+    """Converts a datetime, ISO 8601 string or datetime64 to epoch nanoseconds."""
+    if isinstance(ts, np.datetime64):
+        return int(ts.astype('datetime64[ns]').astype(np.int64))
+    return int(smip_payload.to_datetime64(ts).astype(np.int64))
+
+
+def _text(ns: int) -> str:
+    return str(np.datetime_as_string(np.datetime64(ns, 'ns').astype('datetime64[us]'), unit='us')) + '+00:00'
+
+
+class TimeSeriesCache:
+    """Caches history per tag in blocks of block_seconds, each stored as a file holding the sample count,
+    then the epoch-ns timestamps, then the values. Only blocks that ended more than settle seconds ago
+    are cached, since newer ones may still be filled in. A query fetches the blocks it is missing from
+    SMIP, in as few sharded queries as possible, and reads the rest from disk.
+    Blocks are evicted least recently used first once they take more than max_bytes. Cached blocks are
+    not updated by writes, so callers that add or clear data in a settled range must call invalidate().
+    """
+
+    def __init__(self, conn: SMIP, directory: str = 'tscache', block_seconds: int = 60,
+                 max_bytes: int = 2 ** 30, settle: float = 300) -> None:
+        self.conn = conn
+        self.directory = directory
+        self.block = int(block_seconds * 10 ** 9)
+        self.max_bytes = max_bytes
+        self.settle = settle
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        # Incremented on every invalidation, so a fetch that overlapped one is not stored
+        self.__generation = 0
+        self.__index_path = os.path.join(directory, 'index.json')
+        os.makedirs(directory, exist_ok=True)
+        # (id, block number) -> [file size, last used]
+        self.__index: Dict[Tuple[int, int], List[float]] = dict()
+        if os.path.exists(self.__index_path):
+            with open(self.__index_path, 'r') as f:
+                for key, entry in json.load(f).items():
+                    id, k = key.split('/')
+                    if os.path.exists(self.__path(int(id), int(k))):
+                        self.__index[(int(id), int(k))] = entry
+        self.size = sum(entry[0] for entry in self.__index.values())
+
+    def __path(self, id: int, k: int) -> str:
+        return os.path.join(self.directory, str(id), f'{k}.blk')
+
+    def __save_index(self) -> None:
+        tmp = self.__index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({f'{id}/{k}': entry for (id, k), entry in self.__index.items()}, f)
+        os.replace(tmp, self.__index_path)
+
+    def __load(self, id: int, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        with open(self.__path(id, k), 'rb') as f:
+            n = int(np.fromfile(f, dtype=np.int64, count=1)[0])
+            ts = np.fromfile(f, dtype=np.int64, count=n)
+            values = np.fromfile(f, dtype=np.float64, count=n)
+        return ts, values
+
+    def __store(self, id: int, k: int, ts: np.ndarray, values: np.ndarray) -> None:
+        path = self.__path(id, k)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(np.int64(len(ts)).tobytes())
+            f.write(ts.astype(np.int64).tobytes())
+            f.write(values.astype(np.float64).tobytes())
+        size = 8 * (1 + 2 * len(ts))
+        old = self.__index.get((id, k))
+        self.size += size - (old[0] if old else 0)
+        self.__index[(id, k)] = [size, time()]
+
+    def __remove(self, key: Tuple[int, int]) -> None:
+        self.size -= self.__index.pop(key)[0]
+        try:
+            os.remove(self.__path(*key))
+        except FileNotFoundError:
+            pass
+
+    def __evict(self) -> None:
+        if self.size <= self.max_bytes:
+            return
+        for key in sorted(self.__index, key=lambda key: self.__index[key][1]):
+            self.__remove(key)
+            if self.size <= self.max_bytes:
+                break
+
+    def covered(self, id: int) -> List[Tuple[int, int]]:
+        """Returns the epoch-ns [start, end) ranges cached for a tag."""
+        with self.__lock:
+            blocks = sorted(k for (tag, k) in self.__index if tag == id)
+        ranges = list()
+        for k in blocks:
+            if ranges and ranges[-1][1] == k * self.block:
+                ranges[-1] = (ranges[-1][0], (k + 1) * self.block)
+            else:
+                ranges.append((k * self.block, (k + 1) * self.block))
+        return ranges
+
+    def invalidate(self, id: int, first, last) -> None:
+        """Drops the cached blocks of a tag overlapping [first, last]."""
+        k0, k1 = _ns(first) // self.block, _ns(last) // self.block
+        with self.__lock:
+            self.__generation += 1
+            keys = [key for key in self.__index if key[0] == id and k0 <= key[1] <= k1]
+            for key in keys:
+                self.__remove(key)
+            if keys:
+                self.__save_index()
+
+    def __fetch(self, id: int, k0: int, k1: int, timeout: float) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        """Fetches blocks k0 to k1 of a tag from SMIP, returns them by block number."""
+        start, end = k0 * self.block, (k1 + 1) * self.block
+        ts, values = self.conn.get_data_sharded(_text(start), _text(end), [id], shards=min(k1 - k0 + 1, 8),
+                                                timeout=timeout)[id]
+        edges = np.searchsorted(ts, np.arange(k0, k1 + 2) * self.block)
+        return {k: (ts[edges[i]:edges[i + 1]], values[edges[i]:edges[i + 1]])
+                for i, k in enumerate(range(k0, k1 + 1))}
+
+    def get_data_arrays(self, start_time, end_time, ids: List[int],
+                        timeout: float = None) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        """Gets timeseries like SMIP.get_data_arrays, but without the sample before the start time."""
+        start, end = _ns(start_time), _ns(end_time)
+        k0, k1 = start // self.block, end // self.block
+        # Last block that has settled
+        k_settled = min(k1, int((time() - self.settle) * 1e9) // self.block - 1)
+        data = dict()
+        for id in ids:
+            id = int(id)
+            with self.__lock:
+                generation = self.__generation
+                missing = [k for k in range(k0, k_settled + 1) if (id, k) not in self.__index]
+                self.hits += max(k_settled - k0 + 1, 0) - len(missing)
+                self.misses += len(missing)
+            # Fetch consecutive missing blocks together
+            fetched = dict()
+            run_start = 0
+            for i in range(len(missing)):
+                if i + 1 == len(missing) or missing[i + 1] != missing[i] + 1:
+                    fetched.update(self.__fetch(id, missing[run_start], missing[i], timeout))
+                    run_start = i + 1
+            blocks = dict()
+            with self.__lock:
+                store = bool(fetched) and generation == self.__generation
+                for k in range(k0, k_settled + 1):
+                    if k in fetched:
+                        blocks[k] = fetched[k]
+                        if store:
+                            self.__store(id, k, *fetched[k])
+                    elif (id, k) in self.__index:
+                        blocks[k] = self.__load(id, k)
+                        self.__index[(id, k)][1] = time()
+                if store:
+                    self.__evict()
+                    self.__save_index()
+            # Blocks evicted or invalidated since they were looked up
+            for k in range(k0, k_settled + 1):
+                if k not in blocks:
+                    blocks.update(self.__fetch(id, k, k, timeout))
+            ts_parts = [blocks[k][0] for k in range(k0, k_settled + 1)]
+            value_parts = [blocks[k][1] for k in range(k0, k_settled + 1)]
+            if k_settled < k1:
+                # Recent data is always fetched
+                tail_start = max(start, (k_settled + 1) * self.block)
+                ts, values = self.conn.get_data_arrays(_text(tail_start), _text(end), [id], timeout=timeout)[id]
+                # Drop the sample SMIP returns before the start, it is already in the last block
+                keep = ts >= tail_start
+                ts_parts.append(ts[keep])
+                value_parts.append(values[keep])
+            ts, values = np.concatenate(ts_parts), np.concatenate(value_parts)
+            keep = (ts >= start) & (ts <= end)
+            data[id] = (ts[keep], values[keep])
+        return data
+
+    def close(self) -> None:
+        """Saves when each block was last used."""
+        with self.__lock:
+            self.__save_index()